@@ -3,6 +3,13 @@ import time
 
 
 class Moderator(Plugin):
+    indexes = {
+        "admin": [
+            [("user", 1), ("server", 1), ("lifted", 1), ("type", 1)],
+            [("type", 1), ("lifted", 1)],
+        ]
+    }
+
     def __init__(self, bot):
         self.bot = bot
         if not self.bot.server.type == "discord":
@@ -14,47 +21,26 @@ class Moderator(Plugin):
         self.asyncio = asyncio
 
         self.db = self.bot.util.get_db()["admin"]
+        self.adb = self.bot.util.get_async_db()["admin"]
 
         async def delete_entry(entry):
-            self.db.remove_all({"user": entry["user"], "server": entry["server"]})
-
-        # setup coroutines for unmuting users muted in a previous session
-        for mute in self.db.find({"type": "mute", "lifted": False}):
-            if not mute["end"]:
-                continue
-            duration = (mute["end"] - time.time()) if mute["end"] >= time.time() else 0
-            server = self.bot.server.client.get_guild(mute["server"])
-            user = server.get_member(mute["user"])
-            mute_role = self.get_mute_role(server)
-
-            self.bot.server.gaysyncio(
-                [
-                    # wait until their sentence is up
-                    [self.asyncio.sleep, (duration,), {}],
-                    # remove the entry from the db
-                    [self.lift_action, ("mute", mute["user"], mute["server"]), {}],
-                    # remove their role
-                    [self.remove_role, (user, mute_role), {}],
-                ]
-            )
-
-        for ban in self.db.find({"type": "ban", "lifted": False}):
-            if not ban["end"]:
-                continue
-            duration = (ban["end"] - time.time()) if ban["end"] >= time.time() else 0
-            server = self.bot.server.client.get_guild(ban["server"])
-            user = self.bot.server.client.get_user(ban["user"])
+            await self.adb.delete_many({"user": entry["user"], "server": entry["server"]})
 
-            self.bot.server.gaysyncio(
-                [
-                    # wait until their sentence is up
-                    [self.asyncio.sleep, (duration,), {}],
-                    # remove the entry from the db
-                    [self.lift_action, ("ban", ban["user"], ban["server"]), {}],
-                    # remove their role
-                    [self.unban, (server, user), {}],
-                ]
-            )
+        # sentences are lifted by the bot's scheduler, which keeps them across restarts
+        self.bot.scheduler.register("moderator.unmute", self.scheduled_unmute)
+        self.bot.scheduler.register("moderator.unban", self.scheduled_unban)
+        scheduled = {
+            (a["action"], a["data"]["user"], a["data"]["server"])
+            for a in self.bot.scheduler.pending()
+            if a["action"].startswith("moderator.")
+        }
+        # pick up sentences from before the scheduler existed
+        for entry in self.db.find({"lifted": False, "end": {"$ne": None}}):
+            action = "moderator.un" + entry["type"]
+            if (action, entry["user"], entry["server"]) not in scheduled:
+                self.bot.scheduler.schedule_at(
+                    entry["end"], action, user=entry["user"], server=entry["server"]
+                )
 
         self.interface = bot.util.Interface(
             "mod",  # plugin name
@@ -178,21 +164,17 @@ class Moderator(Plugin):
 
         users = message.raw_message.mentions
 
-        def ban(r):
+        async def ban(r):
             for user in users:
-                calls = [
+                self.bot.server.gaysyncio(
                     [
-                        user.guild.ban,
-                        (user,),
-                        {"reason": reason, "delete_message_days": 0},
+                        [
+                            user.guild.ban,
+                            (user,),
+                            {"reason": reason, "delete_message_days": 0},
+                        ]
                     ]
-                ]
-                if not forever:
-                    calls += [
-                        [self.asyncio.sleep, (duration,), {},],
-                        [self.unban, (user.guild, user), {}],
-                    ]
-                self.bot.server.gaysyncio(calls)
+                )
                 # send audit message
                 self.bot.msg(
                     self.bot.config["audit_channel"],
@@ -206,7 +188,7 @@ class Moderator(Plugin):
                     ),
                 )
                 # save to database
-                self.db.insert_one(
+                await self.adb.insert_one(
                     {
                         "type": "ban",
                         "user": user.id,
@@ -216,6 +198,10 @@ class Moderator(Plugin):
                         "lifted": False,
                     }
                 )
+                if not forever:
+                    self.bot.scheduler.schedule_in(
+                        duration, "moderator.unban", user=user.id, server=user.guild.id
+                    )
                 # Send mod confirmation
                 self.bot.msg(message.target, "User was banned.", follows=message)
 
@@ -241,11 +227,28 @@ class Moderator(Plugin):
 
     # marks an action as lifted in the db
     async def lift_action(self, action, user, server):
-        self.db.update_one(
+        await self.adb.update_one(
             {"type": action, "user": user, "server": server, "lifted": False},
             {"$set": {"lifted": True}},
         )
 
+    async def scheduled_unmute(self, user, server):
+        await self.lift_action("mute", user, server)
+        guild = self.bot.server.client.get_guild(server)
+        if not guild:
+            return
+        member = guild.get_member(user)
+        mute_role = self.get_mute_role(guild)
+        # they may have left the server since
+        if member and mute_role:
+            await self.remove_role(member, mute_role)
+
+    async def scheduled_unban(self, user, server):
+        await self.lift_action("ban", user, server)
+        guild = self.bot.server.client.get_guild(server)
+        if guild:
+            await self.unban(guild, self.discord.Object(id=user))
+
     @Plugin.authenticated
     def mute(
         self,
@@ -276,23 +279,12 @@ class Moderator(Plugin):
             )
         users = message.raw_message.mentions
 
-        def mute(r):
+        async def mute(r):
             for user in users:
-                calls = []
                 # give the mute role to the user
-                calls.append([self.add_role, (user, mute_role), {}])
-                if not forever:
-                    # wait until their sentence is up
-                    calls.append([self.asyncio.sleep, (duration,), {}])
-                    # lift from the db
-                    calls.append(
-                        [self.lift_action, ("mute", user.id, user.guild.id), {}]
-                    )
-                    # remove their role
-                    calls.append([self.remove_role, (user, mute_role), {}])
-                self.bot.server.gaysyncio(calls)
+                self.bot.server.gaysyncio([[self.add_role, (user, mute_role), {}]])
 
-                if self.db.find_one(
+                if await self.adb.find_one(
                     {"user": user.id, "server": user.guild.id, "lifted": False}
                 ):
                     raise self.bot.util.RuntimeError(
@@ -302,7 +294,7 @@ class Moderator(Plugin):
                     )
 
                 # store the mute so we can continue the sentence after restart
-                self.db.insert_one(
+                await self.adb.insert_one(
                     {
                         "type": "mute",
                         "user": user.id,
@@ -313,6 +305,10 @@ class Moderator(Plugin):
                         "lifted": False,
                     }
                 )
+                if not forever:
+                    self.bot.scheduler.schedule_in(
+                        duration, "moderator.unmute", user=user.id, server=user.guild.id
+                    )
 
                 # send a message to the audit log
                 self.bot.msg(
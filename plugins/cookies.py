@@ -4,32 +4,361 @@ import time
 import random
 import base64
 import asyncio
+import threading
+from collections import OrderedDict
+from taiiwobot.storage import UpdateOne
+
+
+class Wallets:
+    """Write-behind cache of cookie wallets
+
+    Each user is read from the database once, after that their balance and
+    items are changed in memory. The changes pile up as $inc deltas, which
+    flush() writes in one bulk_write. Debit guards are checked against the
+    cache, so this process must be the only one writing to the collection.
+
+    Every flush is a batch that's saved to a journal collection before it's
+    applied, and deleted after. Wallets remember the last batch they took,
+    so a batch left in the journal by a crash can be replayed safely.
+
+    Args:
+        db (Repository): The collection, used by flush()
+        adb (AsyncRepository): The same collection, used for loading
+        journal (Repository): Collection for batches that aren't applied yet
+        size (int, optional): Number of clean wallets kept in memory
+    """
+
+    def __init__(self, db, adb, journal, size=10000):
+        self.db = db
+        self.adb = adb
+        self.journal = journal
+        self.size = size
+        self.wallets = OrderedDict()
+        # {user_id: {field: delta}} not yet written to the database
+        self.deltas = {}
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        # functions called with (user_id, field, value) after every change
+        self.listeners = []
+        # finish the batches of the last run before anything is loaded
+        self.batches = list(self.journal.find({}).sort("_id"))
+        self.sequence = self.batches[-1]["_id"] if self.batches else 0
+        self.flush()
+
+    async def get(self, user_id):
+        """Returns the cached wallet of a user, loading it on a miss"""
+        wallet = self.wallets.get(user_id)
+        if wallet is None:
+            # only the fields a wallet needs, not eg. the user's roles
+            loaded = await self.adb.find_one(
+                {"user": user_id}, {"user": 1, "cookies": 1, "items": 1}
+            )
+            with self.lock:
+                # another load may have finished while we were waiting
+                wallet = self.wallets.setdefault(
+                    user_id, loaded or {"user": user_id, "cookies": 0}
+                )
+        with self.lock:
+            if user_id in self.wallets:
+                self.wallets.move_to_end(user_id)
+        return wallet
+
+    def locate(self, wallet, field):
+        # returns the dict holding a field and its key, eg. "items.Milk"
+        *parents, key = field.split(".")
+        for parent in parents:
+            wallet = wallet.setdefault(parent, {})
+        return wallet, key
+
+    async def transfer(self, entries):
+        """Applies several changes to wallets as one, eg. both sides of a trade
+
+        The changes always end up in the same batch, so they reach the
+        database together or not at all.
+
+        Args:
+            entries (list): (user_id, field, amount) tuples
+
+        Returns:
+            bool: False, changing nothing, if any field would go below 0
+        """
+        loaded = {}
+        for user_id, field, amount in entries:
+            loaded[user_id] = await self.get(user_id)
+        with self.lock:
+            totals = {}
+            for user_id, field, amount in entries:
+                totals[user_id, field] = totals.get((user_id, field), 0) + amount
+            # an evicted wallet is put back, it's still up to date
+            wallets = {u: self.wallets.setdefault(u, w) for u, w in loaded.items()}
+            # check every entry before applying any of them
+            for (user_id, field), amount in totals.items():
+                parent, key = self.locate(wallets[user_id], field)
+                if amount < 0 and parent.get(key, 0) + amount < 0:
+                    return False
+            changes = []
+            for (user_id, field), amount in totals.items():
+                parent, key = self.locate(wallets[user_id], field)
+                parent[key] = parent.get(key, 0) + amount
+                delta = self.deltas.setdefault(user_id, {})
+                delta[field] = delta.get(field, 0) + amount
+                changes.append((user_id, field, parent[key]))
+        for listener in self.listeners:
+            for change in changes:
+                listener(*change)
+        return True
+
+    async def inc(self, user_id, field, amount):
+        """Adds to a numeric field of a wallet
+
+        Returns:
+            bool: False, changing nothing, if the field would go below 0
+        """
+        return await self.transfer([(user_id, field, amount)])
+
+    async def set(self, user_id, field, value):
+        # stored as a delta too, so it can't undo increments not yet flushed
+        wallet = await self.get(user_id)
+        parent, key = self.locate(wallet, field)
+        return await self.inc(user_id, field, value - parent.get(key, 0))
+
+    def batch(self):
+        # turns the pending deltas into a journal batch
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+            if not deltas:
+                return
+            entries = []
+            unsets = []
+            for user_id, delta in deltas.items():
+                # the deltas are kept even if the wallet was evicted meanwhile
+                wallet = self.wallets.get(user_id, {})
+                for field, amount in delta.items():
+                    entries.append([user_id, field, amount])
+                    # empty lunchbox slots are removed
+                    parent, key = self.locate(wallet, field)
+                    if field.startswith("items.") and parent.get(key) == 0:
+                        del parent[key]
+                        unsets.append([user_id, field])
+            self.sequence = max(self.sequence + 1, time.time_ns())
+            self.batches.append(
+                {"_id": self.sequence, "entries": entries, "unsets": unsets}
+            )
+
+    def apply(self, batch):
+        sequence = batch["_id"]
+        self.journal.replace_one({"_id": sequence}, batch, upsert=True)
+        deltas = {}
+        for user_id, field, amount in batch["entries"]:
+            deltas.setdefault(user_id, {})[field] = amount
+        requests = []
+        for user_id, delta in deltas.items():
+            # make sure the wallet exists, then apply the batch unless it already was
+            requests.append(
+                UpdateOne({"user": user_id}, {"$inc": {"cookies": 0}}, upsert=True)
+            )
+            requests.append(
+                UpdateOne(
+                    {
+                        "user": user_id,
+                        "$or": [
+                            {"journal_sequence": {"$lt": sequence}},
+                            {"journal_sequence": {"$exists": False}},
+                        ],
+                    },
+                    {"$inc": delta, "$set": {"journal_sequence": sequence}},
+                )
+            )
+        for user_id, field in batch["unsets"]:
+            requests.append(
+                UpdateOne({"user": user_id, field: 0}, {"$unset": {field: ""}})
+            )
+        self.db.bulk_write(requests)
+        self.journal.delete_one({"_id": sequence})
+
+    def flush(self):
+        """Writes all pending deltas to the database. Safe to call from any thread"""
+        with self.flushing:
+            self.batch()
+            # a batch that failed stays queued and is retried first next time
+            while self.batches:
+                self.apply(self.batches[0])
+                self.batches.pop(0)
+        with self.lock:
+            # evict the least recently used wallets that have nothing pending
+            for user_id in list(self.wallets):
+                if len(self.wallets) <= self.size:
+                    break
+                if user_id not in self.deltas:
+                    del self.wallets[user_id]
+
+
+class Leaderboard:
+    """The users with the most cookies, kept up to date from balance changes
+
+    Holds the exact top of the collection, somewhere between `shown` and
+    `size` users. Anyone who passes the lowest balance on the board joins it,
+    and anyone who falls below it leaves, as someone else may have passed
+    them. Once fewer than `shown` are left it needs loading again.
+
+    Args:
+        db (Repository): The cookies collection
+        size (int, optional): Most users kept. Defaults to 100.
+        shown (int, optional): Users in a leaderboard. Defaults to 10.
+    """
+
+    def __init__(self, db, size=100, shown=10):
+        self.db = db
+        self.size = size
+        self.shown = shown
+        self.balances = {}
+        # True if users outside the board may have cookies
+        self.full = False
+        # users never shown, eg. the house wallet
+        self.excluded = set()
+        self.lock = threading.Lock()
+
+    def exclude(self, user_id):
+        with self.lock:
+            self.excluded.add(user_id)
+            self.balances.pop(user_id, None)
+
+    def load(self):
+        top = self.db.find(
+            {"cookies": {"$gt": 0}, "user": {"$nin": list(self.excluded)}},
+            {"user": 1, "cookies": 1},
+            sort=[("cookies", -1)],
+            limit=self.size,
+        )
+        with self.lock:
+            self.balances = {d["user"]: d["cookies"] for d in top}
+            self.full = len(self.balances) == self.size
+
+    @property
+    def stale(self):
+        return self.full and len(self.balances) < self.shown
+
+    def update(self, user_id, cookies):
+        with self.lock:
+            if user_id in self.excluded:
+                return
+            others = [c for u, c in self.balances.items() if u != user_id]
+            lowest = min(others) if others else 0
+            if cookies <= 0 or (self.full and cookies < lowest):
+                self.balances.pop(user_id, None)
+                return
+            self.balances[user_id] = cookies
+            if len(self.balances) > self.size:
+                del self.balances[min(self.balances, key=self.balances.get)]
+                self.full = True
+
+    def top(self, include=None):
+        """Returns the top (user_id, cookies) pairs, optionally only of some users
+
+        Args:
+            include (function, optional): Returns True for the users to show
+
+        Returns:
+            list: The pairs, or None if the board can't tell, eg. because
+                too few of the given users are on it
+        """
+        with self.lock:
+            ranked = sorted(self.balances.items(), key=lambda b: -b[1])
+        if include is not None:
+            ranked = [b for b in ranked if include(b[0])]
+        if self.full and len(ranked) < self.shown:
+            return None
+        return ranked[: self.shown]
+
+    def rank(self, user_id):
+        # the user's rank if they're on the board, else None
+        with self.lock:
+            if user_id not in self.balances:
+                return None
+            cookies = self.balances[user_id]
+            return 1 + sum(1 for c in self.balances.values() if c > cookies)
+
+
+class DropTable:
+    """Weighted random choice in constant time, using Vose's alias method
+
+    Args:
+        weights (dict): Outcomes and their relative weights
+    """
+
+    def __init__(self, weights):
+        self.outcomes = list(weights)
+        total = sum(weights.values())
+        n = len(self.outcomes)
+        # scale so the average probability is 1
+        scaled = [weights[o] * n / total for o in self.outcomes]
+        self.probability = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            # the large outcome fills the rest of the small one's column
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+
+    def draw(self, rng=random):
+        column = rng.randrange(len(self.outcomes))
+        if rng.random() < self.probability[column]:
+            return self.outcomes[column]
+        return self.outcomes[self.alias[column]]
 
 
 class Cookies(Plugin):
+    indexes = {"cookies": [[("user", 1)], [("cookies", -1)], [("roles.end", 1)]]}
+
     def __init__(self, bot):
         self.bot = bot
         self.db = self.bot.util.get_db()["cookies"]
+        # the awaitable version of self.db, used from commands and callbacks
+        self.adb = self.bot.util.get_async_db()["cookies"]
+        adb = self.adb
+        # balances are cached and written back every few seconds
+        self.wallets = Wallets(
+            self.db, self.adb, self.bot.util.get_db()["cookie_journal"]
+        )
+        wallets = self.wallets
+        self.leaderboard = Leaderboard(self.db)
+        self.leaderboard.load()
+        self.wallets.listeners.append(
+            lambda user_id, field, value: field == "cookies"
+            and self.leaderboard.update(user_id, value)
+        )
+        self.flusher = bot.util.thread(self.flush_wallets, name="cookie-wallets")
+        # dice rolls anyone can verify once the seed is revealed
+        self.fair_dice = bot.rng.dice("cookies", self.bot.util.get_db()["rng_seeds"])
         stock = [
-            # emoji, description, price
-            ["🥛", "Milk", 5, "FFFFFF"],
-            ["🥞", "Blueberry Pancakes", 20, "5859E0"],
-            ["🥓", "Bacon", 15, "CF5F18"],
-            ["🥩", "Steak", 30, "683618"],
-            ["🥗", "Salad", 10, "83ce89"],
-            ["🍜", "Ramen", 15, "fee379"],
-            ["🍚", "Rice", 12, "fffdd9"],
-            ["🧁", "Cupcake", 15, "F0A0AE"],
-            ["🍩", "Doughnut", 15, "966c4c"],
-            ["🍵", "Green Tea", 3, "BAD80A"],
-            ["☕", "Coffee", 5, "99643C"],
-            ["🍶", "Sake", 10, "eae6d2"],
+            # emoji, description, price, role colour, drop weight, article
+            ["🥛", "Milk", 5, "FFFFFF", 512, "Some"],
+            ["🥞", "Blueberry Pancakes", 20, "5859E0", 1, "Some"],
+            ["🥓", "Bacon", 15, "CF5F18", 16, "Some"],
+            ["🥩", "Steak", 30, "683618", 1, "A"],
+            ["🥗", "Salad", 10, "83ce89", 128, "A"],
+            ["🍜", "Ramen", 15, "fee379", 8, "Some"],
+            ["🍚", "Rice", 12, "fffdd9", 32, "Some"],
+            ["🧁", "Cupcake", 15, "F0A0AE", 4, "A"],
+            ["🍩", "Doughnut", 15, "966c4c", 2, "A"],
+            ["🍵", "Green Tea", 3, "BAD80A", 1024, "Some"],
+            ["☕", "Coffee", 5, "99643C", 256, "A"],
+            ["🍶", "Sake", 10, "eae6d2", 64, "Some"],
         ]
         self.stock = stock
-        self.cross_png = base64.decodestring(
+        # stock lookups, by reaction and by the names used in lunchboxes
+        self.stock_by_emoji = {item[0]: item for item in stock}
+        self.stock_by_name = {item[1]: item for item in stock}
+        stock_by_emoji = self.stock_by_emoji
+        plugin = self
+        self.cross_png = base64.decodebytes(
             b"iVBORw0KGgoAAAANSUhEUgAAAA8AAAAPBAMAAADJ+Ih5AAAAG1BMVEVHcEzdLkTdLkTdLkTdLkTdLkTdLkTdLkTdLkSk3kMyAAAACHRSTlMAHdvcF1I6OV1IEpIAAABdSURBVAjXNc0xDoAwCAXQz6Bz056gi/YIjI2me0fP08Ue2w8qC+EFPlgqWA24MruUjnMEII4K0UwwTiNEU9LuQJoOwDpv74ifSNnUd3iSjCzDsnDYlJj8/tKO//sD7u0O9OvZ4HcAAAAASUVORK5CYII="
         )
-        self.cookie_png = base64.decodestring(
+        self.cookie_png = base64.decodebytes(
             b"iVBORw0KGgoAAAANSUhEUgAAAA8AAAAPCAMAAAAMCGV4AAAAVFBMVEXboITboITboITboITboITboITboIRHcEzboITboITboITboITboITboITboITboITboITZnoLEiW/XnICkaFLRlnu1emK+g2rLkHaWWEKNTDeTUz4PnvnzAAAAEXRSTlP/KbtPZ1lAAHIzBxbM18Wl5ZgtcSsAAACHSURBVAjXLY8JDoUwCESndte/QV2q3v+eH6gklHmBMBRZo5YQ0qwKkvEFCXq7wVEJfDYU5Yq1aZsJ8MITCNvebOg3o2o9LrYVSCgm9k3L2oIwW4/vQ96CSNeqvJ9svBCPXRYV+fvIJrYf8XOmO+jYUPU+ceh315Ew7vd6EjCl5z85u1D8YuoP8/AGR+6gjvEAAAAASUVORK5CYII="
         )
         self.interface = bot.util.Interface(
@@ -102,137 +431,112 @@ class Cookies(Plugin):
                     ],
                     self.dice,
                 ),
+                bot.util.Interface(
+                    "fair",
+                    "Shows the hash of the dice seed, and the last seed revealed",
+                    [],
+                    self.fair,
+                ),
+                bot.util.Interface(
+                    "reveal",
+                    "Reveals the dice seed and starts a new one",
+                    [],
+                    self.reveal,
+                ),
+                bot.util.Interface(
+                    "top",
+                    "Shows who has the most cookies on this server",
+                    ["w world Show the top of every server 0"],
+                    self.top,
+                ),
+                bot.util.Interface(
+                    "rank",
+                    "Shows your place on the leaderboard. Args: [uid]",
+                    [],
+                    self.rank,
+                ),
             ],
         ).listen()  # sets the on message callbacks and parses messages
 
+        # {guild_id: {item name: role_id}}
+        self.item_roles = {}
+        # {guild_id: {"ids": [emoji_id, emoji_id], "cookie": emoji_id}}, the
+        # ids in random order under random names
+        self.guild_emoji = {}
+        # test emoji are replaced about once every this many drops
+        self.emoji_rotation = 20
+        self.guild_locks = {}
+        self.sweep_lock = threading.Lock()
+        # drop tables by drop rate multiplier, built on first use
+        self.drop_tables = {}
+        # when something last dropped in each channel
+        self.last_drop = {}
+
         @bot.on("message", self.name)
         def spawn_cookie(message):
-            if message.content and (
-                message.content[0] == "$"
-                or message.author == self.bot.server.me()
-                or message.raw_message.author.bot
+            # cheap checks first, most messages never get a roll
+            if (
+                message.author == self.bot.server.me()
+                or getattr(getattr(message.raw_message, "author", None), "bot", False)
+                or (message.content and message.content[0] == "$")
             ):
                 return False
-            roll = random.randint(0, 409600)
-            if roll < 1:
-                self.bot.msg(
-                    message.target,
-                    "A Steak appeared",
-                    reactions=(("🥩", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 2:
-                self.bot.msg(
-                    message.target,
-                    "Some Blueberry Pancakes appeared",
-                    reactions=(("🥞", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 4:
-                self.bot.msg(
-                    message.target,
-                    "A Doughnut appeared",
-                    reactions=(("🍩", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 8:
-                self.bot.msg(
-                    message.target,
-                    "A Cupcake appeared",
-                    reactions=(("🧁", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 16:
-                self.bot.msg(
-                    message.target,
-                    "Some Ramen appeared",
-                    reactions=(("🍜", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 32:
-                self.bot.msg(
-                    message.target,
-                    "Some Bacon appeared",
-                    reactions=(("🥓", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 64:
-                self.bot.msg(
-                    message.target,
-                    "Some Rice appeared",
-                    reactions=(("🍚", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 128:
-                self.bot.msg(
-                    message.target,
-                    "Some Sake appeared",
-                    reactions=(("🍶", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 256:
-                self.bot.msg(
-                    message.target,
-                    "A Salad appeared",
-                    reactions=(("🥗", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 512:
-                self.bot.msg(
-                    message.target,
-                    "A Coffee appeared",
-                    reactions=(("☕", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 1024:
-                self.bot.msg(
-                    message.target,
-                    "Some Milk appeared",
-                    reactions=(("🥛", self.collect_item),),
-                    delete_after=60,
-                )
-            elif roll < 2048:
+            config = self.bot.config.get("plugin_config", {}).get(str(message.server), {})
+            cooldown = config.get("cookie_cooldown", 0)
+            if cooldown and time.time() - self.last_drop.get(message.target, 0) < cooldown:
+                return False
+            drop = self.drop_table(config.get("cookie_drop_rate", 1)).draw(
+                self.bot.rng.stream("drops:%s" % message.server)
+            )
+            if drop is None:
+                return False
+            self.last_drop[message.target] = time.time()
+            if drop == "🍪":
                 self.bot.msg(
                     message.target,
-                    "Some Green Tea appeared",
-                    reactions=(("🍵", self.collect_item),),
+                    "A cookie appeared",
+                    reactions=(("🍪", self.collect_cookie),),
                     delete_after=60,
                 )
-            elif roll < 4098:
-                # cookie
+            else:
+                item = self.stock_by_emoji[drop]
                 self.bot.msg(
                     message.target,
-                    "A cookie appeared",
-                    reactions=(("🍪", self.collect_cookie),),
+                    "%s %s appeared" % (item[5], item[1]),
+                    reactions=((item[0], self.collect_item),),
                     delete_after=60,
                 )
 
         class User:
-            def __init__(self, user_id, db=self.db, init=False):
-                """Object that represents a cookie-having user
+            def __init__(self, user_id, db_user=None, db=adb):
+                """Object that represents a cookie-having user. Use `await User.load()`
+                to read their wallet. Balance and item changes don't need the user
+                to be loaded
 
                 Args:
                     user_id (int): user_id of user
-                    db (MongoClient, optional): The mongodb instance to reference. Defaults to self.db.
-                    init (bool, optional): Should we init the user if not exists?. Defaults to False.
-
-                Returns:
-                    [type]: [description]
+                    db_user (dict, optional): The user's wallet if already loaded. Defaults to None.
+                    db (AsyncRepository, optional): The collection to reference. Defaults to self.adb.
                 """
                 self.id = user_id
                 self.db = db
-                self.db_user = self.db.find_one({"user": self.id})
-                if not self.db_user:
-                    if init:
-                        self.init()
-                    else:
-                        return None
-
-            def init(self, cookies=0):
-                cookies = cookies or 0
-                if not self.db_user:
-                    self.db_user = {"user": self.id, "cookies": cookies}
-                    self.db.insert_one(self.db_user)
+                self.db_user = db_user
+
+            @classmethod
+            async def load(cls, user_id, init=False):
+                """Loads a user from the wallet cache, reading the database on a miss
+
+                Args:
+                    user_id (int): user_id of user
+                    init (bool, optional): Kept for compatibility, wallets always exist. Defaults to False.
+
+                Returns:
+                    User: The loaded user
+                """
+                return cls(user_id, await wallets.get(user_id))
+
+            async def init(self, cookies=0):
+                await self.inc_cookies(cookies or 0)
 
             def cookies(self):
                 """Returns the number of cookies this user has
@@ -241,50 +545,40 @@ class Cookies(Plugin):
                     int: Number of cookies
                 """
                 if self.db_user:
-                    return self.db_user["cookies"]
+                    return self.db_user.get("cookies", 0)
                 else:
                     return 0
 
-            def inc_cookies(self, inc: int):
+            async def inc_cookies(self, inc: int):
                 """Increment the user's cookies by a set amount
 
+                The wallet cache is the only writer, so concurrent updates to
+                the same user are never lost.
+
                 Args:
-                    inc (int): The number of cookies to increment. Can be positive
+                    inc (int): The number of cookies to increment. Can be negative
 
                 Raises:
                     Exception: Function cannot be used to lower a user below 0 cookies
                 """
-                # init user with inc cookies if not exists
-                if not self.db_user:
-                    if inc:
-                        self.init(cookies=inc)
-                        return
-                    else:
-                        raise Exception(
-                            "New user can't have negative cookies!")
-
-                # increment the cookies
-                if self.db_user["cookies"] + inc >= 0:
-                    self.db_user["cookies"] += inc
-                    self.update()
-                else:
-                    raise Exception(
-                        "Existing user cannot have negative cookies!")
+                if not await wallets.inc(self.id, "cookies", inc):
+                    raise Exception("User cannot have negative cookies!")
+                self.db_user = await wallets.get(self.id)
 
-            def add_item(self, item: str, quantity=1):
+            async def add_item(self, item: str, quantity=1):
                 """Gives the user an item
 
                 Args:
                     item (str): The emoji of the desired item
-                    quantity (int, optional): The amount of item to give. Defaults to 1.
+                    quantity (int, optional): The amount of item to give. Can
+                        be negative to take items away. Defaults to 1.
+
+                Returns:
+                    bool: False if the user didn't have enough of the item
                 """
-                if "items" not in self.db_user:
-                    self.db_user["items"] = {}
-                if item[1] in self.db_user["items"]:
-                    self.db_user["items"][item[1]] += quantity
-                else:
-                    self.db_user["items"][item[1]] = quantity
-                self.update()
+                added = await wallets.inc(self.id, "items." + item[1], quantity)
+                self.db_user = await wallets.get(self.id)
+                return added
 
             def get_items(self):
                 """Returns the items the user owns
@@ -292,12 +586,19 @@ class Cookies(Plugin):
                 Returns:
                     Dict: List of items the user owns
                 """
-                return self.db_user["items"]
+                items = self.db_user.get("items", {}) if self.db_user else {}
+                # emptied slots stay in the cache until the next flush
+                return {name: count for name, count in items.items() if count > 0}
 
-            def update(self):
-                """Apply updates to self.db_user to the database
+            async def update(self, fields):
+                """Sets numeric fields of the user's wallet
+
+                Args:
+                    fields (dict): Field names and their new values
                 """
-                self.db.update({"user": self.id}, {"$set": self.db_user})
+                for field, value in fields.items():
+                    await wallets.set(self.id, field, value)
+                self.db_user = await wallets.get(self.id)
 
             def consume(self, emoji, context):
                 """Consumes the target emoji, handing inventory and applying effects
@@ -310,44 +611,26 @@ class Cookies(Plugin):
                     bot.server.type == "discord"
                     and context.guild.me.guild_permissions.manage_roles
                 ):
-                    import discord
 
                     async def main():
-                        item_a = [i for i in stock if i[0] == emoji][0]
-                        roles = [
-                            r for r in context.guild.roles if r.name == item_a[1]]
-                        if roles:
-                            role = roles[0]
-                        else:
-                            role = await context.guild.create_role(
-                                name=item_a[1],
-                                colour=discord.Colour(int(item_a[3], 16)),
-                            )
-
-                        if not "roles" in self.db_user:
-                            self.db_user["roles"] = []
-                        # update the user object
-                        self.db_user["roles"].append(
-                            {
-                                "role_id": role.id,
-                                "end": time.time() + item_a[2] * 60 * 60 * 24,
-                                "server": context.guild.id,
-                            }
-                        )
-                        if self.db_user["items"][item_a[1]] > 1:
-                            self.db_user["items"][item_a[1]] -= 1
-                        else:
-                            del self.db_user["items"][item_a[1]]
+                        item_a = stock_by_emoji[emoji]
+                        role = await plugin.item_role(context.guild, item_a)
 
-                        print(self.db_user)
-                        self.update()
+                        # eat the item, unless it was already eaten elsewhere
+                        if not await self.add_item(item_a, quantity=-1):
+                            return
+                        role_entry = {
+                            "role_id": role.id,
+                            "end": time.time() + item_a[2] * 60 * 60 * 24,
+                            "server": context.guild.id,
+                        }
+                        await self.db.update_one(
+                            {"user": self.id}, {"$push": {"roles": role_entry}}, upsert=True
+                        )
                         # give the user the role
-                        print(role)
                         await context.author.add_roles(role)
-                        # wait until the role expires
-                        await asyncio.sleep(item_a[2] * 60 * 60 * 24)
-                        # remove the role
-                        await context.author.remove_roles(role)
+                        # take it away again when it expires
+                        await plugin.schedule_sweep_async(role_entry["end"])
 
                     bot.server.gaysyncio(
                         [
@@ -357,31 +640,287 @@ class Cookies(Plugin):
 
         self.User = User
 
-        async def remove_role(uid, role):
-            server = self.bot.server.client.get_guild(role["server"])
-            role_obj = server.get_role(role["role_id"])
-            if not role_obj:
-                print("broken user: " + str(uid) + str(role))
-            member = server.get_member(uid)
-            if member:
-                print("removing role for " + member.name)
-                await member.remove_roles(role_obj)
-
-            self.db.update(
-                {"user": uid},
-                {"$pull": {"roles": role}},
-            )
+        # expired roles are removed by one sweep, scheduled for the next expiry
+        self.bot.scheduler.register("cookies.sweep_roles", self.sweep_roles)
+        # per role actions from before the sweeper are covered by it
+        for action in self.bot.scheduler.pending("cookies.remove_role"):
+            self.bot.scheduler.cancel(action["_id"])
+        if self.bot.server.type == "discord":
+            self.schedule_sweep(time.time())
+
+    def guild_lock(self, guild_id):
+        # stops two commands creating the same role or emoji at once
+        return self.guild_locks.setdefault(guild_id, asyncio.Lock())
+
+    async def item_role(self, guild, item):
+        """Returns the guild's role for a stock item, creating it the first time"""
+        roles = self.item_roles.setdefault(guild.id, {})
+        role = guild.get_role(roles[item[1]]) if item[1] in roles else None
+        if role:
+            return role
+        async with self.guild_lock(guild.id):
+            role = next((r for r in guild.roles if r.name == item[1]), None)
+            if not role:
+                import discord
+
+                role = await guild.create_role(
+                    name=item[1], colour=discord.Colour(int(item[3], 16))
+                )
+            roles[item[1]] = role.id
+        return role
 
-        # set up the coroutines to remove expired roles
-        for user in self.db.find({"roles": {"$exists": True}}):
-            if self.bot.server.type == "discord":
+    async def test_emoji(self, guild, rng):
+        """Returns the guild's two test emoji and the id of the cookie
+
+        The pair is uploaded under random names, with the cookie in a random
+        place, and reused for a while. Every so often a drop replaces it, so
+        neither the names nor the ids say which one is the cookie for long.
+        """
+        client = self.bot.server.client
+        pair = self.guild_emoji.get(guild.id)
+        if pair and rng.randrange(self.emoji_rotation):
+            emoji = [client.get_emoji(i) for i in pair["ids"]]
+            if all(emoji):
+                return emoji, pair["cookie"]
+        async with self.guild_lock(guild.id):
+            if self.guild_emoji.get(guild.id) is not pair:
+                # another drop replaced it while we waited
+                pair = self.guild_emoji[guild.id]
+                return [client.get_emoji(i) for i in pair["ids"]], pair["cookie"]
+            # the pair being replaced, and any left over from earlier runs
+            for old in [e for e in guild.emojis if self.is_test_emoji(e.name)]:
+                await old.delete()
+            images = [self.cross_png, self.cookie_png]
+            rng.shuffle(images)
+            emoji = [
+                await guild.create_custom_emoji(
+                    name="cookie_%06x" % rng.randrange(16 ** 6), image=image
+                )
+                for image in images
+            ]
+            cookie = emoji[images.index(self.cookie_png)].id
+            self.guild_emoji[guild.id] = {"ids": [e.id for e in emoji], "cookie": cookie}
+        return emoji, cookie
+
+    @staticmethod
+    def is_test_emoji(name):
+        # "cookie1" and "cookie2" were the names before they were random
+        return name in ("cookie1", "cookie2") or (
+            len(name) == 13
+            and name.startswith("cookie_")
+            and all(c in "0123456789abcdef" for c in name[7:])
+        )
+
+    def schedule_sweep(self, due):
+        # keeps a single pending sweep, at the earliest time asked for
+        with self.sweep_lock:
+            pending = self.bot.scheduler.pending("cookies.sweep_roles")
+            if pending and min(a["due"] for a in pending) <= due:
+                return
+            for action in pending:
+                self.bot.scheduler.cancel(action["_id"])
+            self.bot.scheduler.schedule_at(due, "cookies.sweep_roles")
+
+    async def schedule_sweep_async(self, due):
+        # the scheduler writes to the database, so keep it off the event loop
+        await asyncio.wrap_future(self.bot.util.submit(self.schedule_sweep, due))
+
+    async def sweep_roles(self):
+        now = time.time()
+        swept = False
+        try:
+            expired = await self.adb.find(
+                {"roles.end": {"$lte": now}}, {"user": 1, "roles": 1}
+            )
+            # {guild_id: {user_id: [role_id, ...]}}
+            guilds = {}
+            for user in expired:
                 for role in user["roles"]:
-                    self.bot.server.gaysyncio(
-                        [
-                            [asyncio.sleep, (role["end"] - time.time(),), {}],
-                            [remove_role, (user["user"], role), {}],
-                        ]
-                    )
+                    if role["end"] <= now:
+                        members = guilds.setdefault(role["server"], {})
+                        members.setdefault(user["user"], []).append(role["role_id"])
+            for guild_id, members in guilds.items():
+                guild = self.bot.server.client.get_guild(guild_id)
+                if not guild:
+                    continue
+                for user_id, role_ids in members.items():
+                    member = guild.get_member(user_id)
+                    roles = [r for r in map(guild.get_role, role_ids) if r]
+                    if not member or not roles:
+                        continue
+                    # one call per member, however many of their roles expired
+                    try:
+                        await member.remove_roles(*roles)
+                    except Exception as e:
+                        # eg. missing permissions, the rest still expire
+                        self.bot.util.debug(
+                            "[E] Couldn't remove expired roles from %s in %s: %r"
+                            % (user_id, guild_id, e)
+                        )
+            if expired:
+                await self.adb.bulk_write(
+                    [
+                        UpdateOne(
+                            {"user": user["user"]},
+                            {"$pull": {"roles": {"end": {"$lte": now}}}},
+                        )
+                        for user in expired
+                    ]
+                )
+            swept = True
+        finally:
+            # sleep until the next role expires, or retry in a minute if this failed
+            due = None if swept else time.time() + 60
+            try:
+                following = await self.adb.find_one(
+                    {"roles.end": {"$gt": now}}, {"roles": 1}, sort=[("roles.end", 1)]
+                )
+                if following:
+                    end = min(r["end"] for r in following["roles"] if r["end"] > now)
+                    due = min(due or end, end)
+            except Exception as e:
+                self.bot.util.debug("[E] Couldn't find the next role to expire: %r" % e)
+                due = time.time() + 60
+            if due:
+                await self.schedule_sweep_async(due)
+
+    def drop_table(self, rate=1):
+        """Returns the drop table for a drop rate multiplier
+
+        Out of every 409601 messages, items drop as often as their stock weight
+        and a cookie drops 2050 times, each multiplied by the rate.
+        """
+        if rate not in self.drop_tables:
+            weights = {item[0]: item[4] * rate for item in self.stock}
+            weights["🍪"] = 2050 * rate
+            weights[None] = max(409601 - sum(weights.values()), 0)
+            self.drop_tables[rate] = DropTable(weights)
+        return self.drop_tables[rate]
+
+    def refresh_leaderboard(self):
+        # the database has to catch up with the cache before it's read
+        self.wallets.flush()
+        self.leaderboard.load()
+        for user_id, wallet in list(self.wallets.wallets.items()):
+            self.leaderboard.update(user_id, wallet.get("cookies", 0))
+
+    async def flush_now(self):
+        # the database has to catch up with the cache before it's counted
+        await asyncio.wrap_future(self.bot.util.submit(self.wallets.flush))
+
+    async def guild_top(self, guild, page=1000, pages=10):
+        """Finds the top of a server by reading the global ranking a page at a time
+
+        Stops after `pages` pages, so a huge collection can't make it unbounded
+        """
+        await self.flush_now()
+        me = self.bot.server.me()
+        ranked = []
+        for i in range(pages):
+            documents = await self.adb.find(
+                {"cookies": {"$gt": 0}},
+                {"user": 1, "cookies": 1},
+                sort=[("cookies", -1)],
+                limit=page,
+                skip=i * page,
+            )
+            ranked += [
+                (d["user"], d["cookies"])
+                for d in documents
+                if d["user"] != me and guild.get_member(d["user"])
+            ]
+            if len(ranked) >= self.leaderboard.shown or len(documents) < page:
+                break
+        return ranked[: self.leaderboard.shown]
+
+    async def top(self, message, world=False):
+        # the house wallet isn't a player
+        self.leaderboard.exclude(self.bot.server.me())
+        if self.leaderboard.stale:
+            await asyncio.wrap_future(self.bot.util.submit(self.refresh_leaderboard))
+        guild = getattr(message.raw_message, "guild", None)
+        include = None if world or not guild else guild.get_member
+        ranked = self.leaderboard.top(include)
+        if ranked is None:
+            # not enough of this server is on the board, ask the database
+            ranked = await self.guild_top(guild)
+        if not ranked:
+            if guild and not world and not getattr(guild, "chunked", True):
+                return self.bot.msg(
+                    message.target,
+                    "I can't see everyone on this server yet, try `top -w`",
+                    follows=message,
+                )
+            return self.bot.msg(message.target, "Nobody has any cookies :(", follows=message)
+        lines = [
+            "%s. %s - %s" % (i + 1, self.bot.server.mention(user_id), cookies)
+            for i, (user_id, cookies) in enumerate(ranked)
+        ]
+        if self.bot.server.type == "discord":
+            # mentions in embeds don't ping anyone
+            self.bot.msg(
+                message.target,
+                "Cookie leaderboard",
+                embed=self.bot.server.embed(desc="\n".join(lines), color="D2691E"),
+                follows=message,
+            )
+        else:
+            self.bot.msg(message.target, "\n".join(lines), follows=message)
+
+    async def rank(self, message, user_id=False):
+        user_id = int(user_id.strip("<@!>")) if user_id else message.author
+        user = await self.User.load(user_id)
+        if not user.cookies():
+            return self.bot.msg(message.target, "No cookies, no rank :(", follows=message)
+        self.leaderboard.exclude(self.bot.server.me())
+        rank = self.leaderboard.rank(user_id)
+        if rank is None:
+            await self.flush_now()
+            rank = 1 + await self.adb.count_documents(
+                {"cookies": {"$gt": user.cookies()}, "user": {"$ne": self.bot.server.me()}}
+            )
+        self.bot.msg(
+            message.target,
+            "%s ranked #%s with %s cookies"
+            % ("That user is" if user_id != message.author else "You're", rank, user.cookies()),
+            follows=message,
+        )
+
+    def fair(self, message):
+        lines = [
+            "Dice rolls are an HMAC-SHA256 of \"<user id>:<roll #>\" keyed by a secret seed.",
+            "Current seed hash: %s" % self.fair_dice.commitment,
+        ]
+        revealed = self.fair_dice.revealed
+        if revealed:
+            lines.append(
+                "Last seed: %s (hash %s, rolls up to #%s)"
+                % (revealed["seed"], revealed["commitment"], revealed["rolls"])
+            )
+        self.bot.msg(message.target, "\n".join(lines), follows=message)
+
+    @Plugin.owner
+    def reveal(self, message):
+        revealed = self.fair_dice.rotate()
+        self.bot.msg(
+            message.target,
+            "Revealed seed %s for rolls up to #%s. New seed hash: %s"
+            % (revealed["seed"], revealed["rolls"], self.fair_dice.commitment),
+            follows=message,
+        )
+
+    def flush_wallets(self):
+        while not self.bot.util.sleep(5):
+            try:
+                self.wallets.flush()
+            except Exception as e:
+                print("[E] Failed to flush cookie wallets: %r" % e)
+
+    def unload(self):
+        super().unload()
+        self.flusher.stop()
+        # write what's left before the bot exits
+        self.wallets.flush()
 
     # flags are parsed and passed to the assigned function like so:
     # *args catches all uncaught command arguments as an array.
@@ -392,11 +931,11 @@ class Cookies(Plugin):
             follows=message,
         )
 
-    def balance(self, message, user_id=False):
+    async def balance(self, message, user_id=False):
         # sends a message to the channel it came from
-        user = self.User(int(user_id.strip("<@!>"))
-                         if user_id else message.author)
-        if not user:
+        user = await self.User.load(int(user_id.strip("<@!>"))
+                                    if user_id else message.author)
+        if not user.cookies():
             self.bot.msg(message.target,
                          "You have no cookies :(", follows=message)
         else:
@@ -423,65 +962,44 @@ class Cookies(Plugin):
         else:
             self.bot.msg(message.target, "You can't do that!")
 
-    def test(self, message):
+    async def test(self, message):
         """An example of a method of dropping cookies that makes it harder to automate collection
 
         Args:
             message (Message): message object
         """
-        user = self.User(message.author)
         if message.author != 200329561437765652:
             self.bot.msg(
                 message.target, "1 cookie removed for being nosey", follows=message
             )
-            user.inc_cookies(-1)
+            try:
+                await self.User(message.author).inc_cookies(-1)
+            except Exception:
+                pass
             return
         # if we're on discord and we have emoji perms
         if (
             self.bot.server.type == "discord"
             and message.raw_message.guild.me.guild_permissions.manage_emojis
         ):
-            def remove_cookie(r): return self.User(
-                r["reactor"]).inc_cookies(-1)
-            r = [1, 2]
-            random.shuffle(r)
-
-            async def send_message(r1, r2):
-                print(r1, r2)
-                self.bot.msg(
-                    message.target,
-                    "A cookie appeared",
-                    reactions=(
-                        (r1, remove_cookie) if r[0] -
-                        1 else (r2, self.collect_cookie),
-                        (r1, remove_cookie) if r[1] -
-                        1 else (r2, self.collect_cookie),
-                    ),
-                    delete_after=60,
-                )
-                await asyncio.sleep(1)
-                await r1.delete()
-                await r2.delete()
-
-            # add emojis
-            self.bot.server.gaysyncio(
-                [
-                    [
-                        message.raw_message.guild.create_custom_emoji,
-                        tuple(),
-                        {"name": "cookie" +
-                            str(r[0]), "image": self.cross_png},
-                    ],
-                    [asyncio.sleep, (0.5,), {}],
-                    [
-                        message.raw_message.guild.create_custom_emoji,
-                        tuple(),
-                        {"name": "cookie" +
-                            str(r[1]), "image": self.cookie_png},
-                    ],
-                    [asyncio.sleep, (0.5,), {}],
-                    [send_message, ("$0", "$2"), {}],
-                ]
+            async def remove_cookie(r):
+                try:
+                    await self.User(r["reactor"]).inc_cookies(-1)
+                except Exception:
+                    pass
+            rng = self.bot.rng.stream("drops:%s" % message.server)
+            emoji, cookie = await self.test_emoji(message.raw_message.guild, rng)
+            reactions = [
+                (e, self.collect_cookie if e.id == cookie else remove_cookie)
+                for e in emoji
+            ]
+            # shuffled, so position gives nothing away
+            rng.shuffle(reactions)
+            self.bot.msg(
+                message.target,
+                "A cookie appeared",
+                reactions=reactions,
+                delete_after=60,
             )
         else:
             # not in discord or no perms
@@ -492,10 +1010,10 @@ class Cookies(Plugin):
                 delete_after=60,
             )
 
-    def drop(self, message):
+    async def drop(self, message):
         try:
-            self.User(message.author).inc_cookies(-1)
-        except:
+            await self.User(message.author).inc_cookies(-1)
+        except Exception:
             self.bot.msg(
                 message.target, "You have no cookies to drop!", follows=message
             )
@@ -523,23 +1041,21 @@ class Cookies(Plugin):
             follows=message,
         )
 
-    def buy(self, r):
-        product = [a for a in self.stock if a[0] == r["emoji"]][0]
-        user = self.User(r["reactor"])
-        try:
-            user.inc_cookies(-product[2])
-        except:
+    async def buy(self, r):
+        product = self.stock_by_emoji[r["emoji"]]
+        if not await self.wallets.transfer(
+            [(r["reactor"], "cookies", -product[2]), (r["reactor"], "items." + product[1], 1)]
+        ):
             self.bot.msg(r["channel"], "You can't afford that!")
             return False
-        user.add_item(product)
         self.bot.msg(
             r["channel"],
             "%s successfully purchased %s %s"
             % (self.bot.server.mention(r["reactor"]), product[0], product[1]),
         )
 
-    def lunchbox(self, message):
-        user = self.User(message.author)
+    async def lunchbox(self, message):
+        user = await self.User.load(message.author)
 
         def consume_handler(r):
             user.consume(r["emoji"], message.raw_message)
@@ -550,21 +1066,16 @@ class Cookies(Plugin):
                 follows=message,
             )
 
-        items = [i for i in self.stock if i[1] in user.get_items()]
+        counts = user.get_items()
+        items = [self.stock_by_name[name] for name in counts if name in self.stock_by_name]
 
-        if not user.db_user["items"]:
+        if not items:
             self.bot.msg(message.target, "Your lunchbox is empty!")
         else:
-            print(items)
             self.bot.msg(
                 message.target,
                 "You open your lunchbox:\n```%s```\nWould you like to eat/drink something?"
-                % "\n".join(
-                    [
-                        "[%s] %s - %s" % (i[0], i[1], user.get_items()[i[1]])
-                        for i in items
-                    ]
-                ),
+                % "\n".join(["[%s] %s - %s" % (i[0], i[1], counts[i[1]]) for i in items]),
                 reactions=[[i[0], consume_handler] for i in items],
                 user=message.author,
                 follows=message,
@@ -586,17 +1097,16 @@ class Cookies(Plugin):
         else:
             target = targets[0]
 
-        def yes(r):
-            try:
-                self.User(message.author).inc_cookies(-amount)
-            except:
+        async def yes(r):
+            if not await self.wallets.transfer(
+                [(message.author, "cookies", -amount), (target, "cookies", amount)]
+            ):
                 self.bot.msg(
                     message.target,
                     "You don't have enough cookies to do that!",
                     follows=message,
                 )
                 return
-            self.User(target).inc_cookies(amount)
             self.bot.msg(
                 message.target,
                 "%s gave %s %s cookies"
@@ -617,9 +1127,13 @@ class Cookies(Plugin):
             delete_after=60,
         )
 
-    def dice(self, message, *args, payout=False, under=False, over=False):
-        amount = args[0]
-        roll = random.randint(1, 100)
+    async def dice(self, message, *args, payout=False, under=False, over=False):
+        # every roll uses up a committed roll number, so only valid bets roll
+        amount = args[0] if args else ""
+        if not amount.isnumeric() or int(amount) < 1:
+            raise self.bot.util.RuntimeError(
+                "Invalid bet amount", message.target, self
+            )
         if payout:
             if payout.isnumeric() and int(payout) > 0:
                 under = 99 / (int(payout) / 100)
@@ -648,49 +1162,58 @@ class Cookies(Plugin):
             # default
             under = 49
             payout = 2
+        user = self.User(message.author)
+        bot = self.User(self.bot.server.me())
+        # the bet goes to the bot
+        if not await self.wallets.transfer(
+            [(user.id, "cookies", -int(amount)), (bot.id, "cookies", int(amount))]
+        ):
+            self.bot.msg(message.target,
+                         "You don't have enough cookies to make that bet!")
+            return
+        roll, roll_number = self.fair_dice.roll(message.author)
         self.bot.msg(
             message.target,
-            "You're betting %s cookies on getting %s or %s. If you win, you will win %s cookies. You rolled: %s"
+            "You're betting %s cookies on getting %s or %s. If you win, you will win %s cookies. You rolled: %s (roll #%s)"
             % (
                 amount,
                 100 - int(under) if over else under,
                 "over" if over else "under",
                 math.floor(int(amount) * payout),
                 100 - roll if over else roll,
+                roll_number,
             ),
         )
-        user = self.User(message.author)
-        if user.cookies() < int(amount):
-            self.bot.msg(message.target,
-                         "You don't have enough cookies to make that bet!")
-            return
-        user.inc_cookies(-int(amount))
-        bot = self.User(self.bot.server.me())
-        bot.inc_cookies(int(amount))
         if roll <= under:
-            self.bot.msg(
-                message.target,
-                "You win %s cookies!" % (math.floor(int(amount) * payout)),
-            )
-            user = self.User(message.author)
-            user.inc_cookies(math.floor(int(amount) * payout))
-            bot = self.User(self.bot.server.me())
-            if bot.cookies() - math.floor(int(amount) * payout) <= 0:
-                bot.db_user["cookies"] = 0
-                bot.update()
+            winnings = math.floor(int(amount) * payout)
+            # the payout comes from the house, which can't go below 0
+            if await self.wallets.transfer(
+                [(bot.id, "cookies", -winnings), (user.id, "cookies", winnings)]
+            ):
+                self.bot.msg(message.target, "You win %s cookies!" % winnings)
+            elif await self.wallets.transfer(
+                [(bot.id, "cookies", -int(amount)), (user.id, "cookies", int(amount))]
+            ):
+                self.bot.msg(
+                    message.target,
+                    "You win, but the house can't cover %s cookies! Your bet was returned."
+                    % winnings,
+                )
             else:
-                bot.inc_cookies(-math.floor(int(amount) * payout))
+                raise self.bot.util.RuntimeError(
+                    "The house couldn't pay out or return your bet", message.target, self
+                )
         else:
             self.bot.msg(message.target, "You lose!")
 
-    def offer(self, message, *args, item=False, amount=False, confirm=False):
+    async def offer(self, message, *args, item=False, amount=False, confirm=False):
         targets = self.bot.server.get_mentions(message)
         if not targets:
             return self.bot.msg(
                 message.target, "No recipient specified.", follows=message
             )
         else:
-            target = self.User(targets[0])
+            target = await self.User.load(targets[0])
         if amount:
             if isinstance(amount, int) or amount.isnumeric():
                 amount = int(amount)
@@ -699,37 +1222,35 @@ class Cookies(Plugin):
                     message.target, "Amount specified is not a number!", follows=message
                 )
         if item:
-            for s in self.stock:
-                if s[1] == item:
-                    item = s
-                    break
+            if item in self.stock_by_name:
+                item = self.stock_by_name[item]
             else:
                 return self.bot.msg(
                     message.target, "Unknown item specified.", follows=message
                 )
         if item and amount and confirm:
 
-            def trade(r):
-                target = self.User(targets[0])
-                if (
-                    item[1] not in target.get_items()
-                    or target.get_items()[item[1]] <= 0
-                ):
-                    self.bot.msg(message.target, "Nice try loser")
-                    return
-                try:
-                    self.User(message.author).inc_cookies(-amount)
-                except:
+            async def trade(r):
+                buyer = await self.User.load(message.author)
+                target = await self.User.load(targets[0])
+                if buyer.cookies() < amount:
                     self.bot.msg(
                         message.target,
                         "You don't have enough cookies to do that!",
                         follows=message,
                     )
                     return
-                target = self.User(targets[0])
-                target.inc_cookies(amount)
-                target.add_item(item, quantity=-1)
-                self.User(message.author).add_item(item)
+                # both sides of the trade happen together, or not at all
+                if not await self.wallets.transfer(
+                    [
+                        (buyer.id, "cookies", -amount),
+                        (target.id, "cookies", amount),
+                        (target.id, "items." + item[1], -1),
+                        (buyer.id, "items." + item[1], 1),
+                    ]
+                ):
+                    self.bot.msg(message.target, "Nice try loser")
+                    return
                 self.bot.msg(
                     message.target,
                     "%s traded %s cookies with %s for %s"
@@ -787,10 +1308,9 @@ class Cookies(Plugin):
                 )
 
             for item in target.get_items():
-                if target.get_items()[item] >= 1:
-                    for s in self.stock:
-                        if s[1] == item:
-                            answers.append([s[0], s[1], a(item)])
+                if item in self.stock_by_name:
+                    s = self.stock_by_name[item]
+                    answers.append([s[0], s[1], a(item)])
             self.bot.menu(
                 message.target,
                 message.author,
@@ -798,29 +1318,104 @@ class Cookies(Plugin):
                 answers=answers,
             )
 
-    def collect_cookie(self, r):
+    async def collect_cookie(self, r):
         if r["reactor"] == self.bot.server.me():
             return
+        # claim the cookie before awaiting, so nobody else can collect it
+        if self.bot.server.reaction_callbacks.pop(r["message"], None) is None:
+            return
         user = self.User(r["reactor"])
         self.bot.msg(
             r["channel"],
             "Cookie collected by %s" % self.bot.server.mention(r["reactor"]),
         )
-        del self.bot.server.reaction_callbacks[r["message"]]
-        user.inc_cookies(1)
+        await user.inc_cookies(1)
 
-    def collect_item(self, r):
+    async def collect_item(self, r):
         if r["reactor"] == self.bot.server.me():
             return
-        del self.bot.server.reaction_callbacks[r["message"]]
-        user = self.User(r["reactor"])
+        if self.bot.server.reaction_callbacks.pop(r["message"], None) is None:
+            return
+        item = self.stock_by_emoji.get(r["emoji"])
+        if not item:
+            return
+        self.bot.msg(
+            r["channel"],
+            "%s collected by %s" % (item[1], self.bot.server.mention(r["reactor"])),
+        )
+        return await self.User(r["reactor"]).add_item(item)
 
-        for item in self.stock:
-            if not r["emoji"] == item[0]:
-                continue
-            self.bot.msg(
-                r["channel"],
-                "%s collected by %s" % (
-                    item[1], self.bot.server.mention(r["reactor"])),
+
+def transfer_benchmark(trades=20000, users=200, concurrency=50):
+    """Runs concurrent trades through the wallet cache over in-memory SQLite
+
+    Prints the trade rate, the flush time and whether every cookie survived,
+    including a replay of a batch that was already applied
+    """
+    from taiiwobot import storage
+
+    database = storage.connect({"engine": "sqlite", "path": ":memory:"})
+    async_database = storage.AsyncDatabase(database)
+    database.ensure_indexes(Cookies.indexes)
+    database["cookies"].insert_many(
+        [{"user": i, "cookies": 100, "items": {"Milk": 5}} for i in range(users)]
+    )
+    # half the users fit in the cache, so trades also cause loads and evictions
+    wallets = Wallets(
+        database["cookies"],
+        async_database["cookies"],
+        database["cookie_journal"],
+        size=users // 2,
+    )
+    done = threading.Event()
+
+    def flusher():
+        while not done.wait(0.05):
+            wallets.flush()
+
+    async def trader(count):
+        for i in range(count):
+            a, b = random.sample(range(users), 2)
+            await wallets.transfer(
+                [
+                    (a, "cookies", -5),
+                    (b, "cookies", 5),
+                    (b, "items.Milk", -1),
+                    (a, "items.Milk", 1),
+                ]
             )
-            return user.add_item(item)
+
+    async def main():
+        await asyncio.gather(*[trader(trades // concurrency) for i in range(concurrency)])
+
+    flush_thread = threading.Thread(target=flusher)
+    flush_thread.start()
+    start = time.time()
+    asyncio.run(main())
+    elapsed = time.time() - start
+    done.set()
+    flush_thread.join()
+    start = time.time()
+    wallets.flush()
+    print("trades/sec: %d" % (trades / elapsed))
+    print("final flush: %.1fms" % ((time.time() - start) * 1000))
+
+    # a batch replayed after a crash must not be applied twice
+    rich = max(database["cookies"].find({}), key=lambda d: d["cookies"])["user"]
+    asyncio.run(wallets.transfer([(rich, "cookies", -1), ((rich + 1) % users, "cookies", 1)]))
+    wallets.batch()
+    batch = wallets.batches[0]
+    wallets.flush()
+    wallets.apply(batch)
+
+    documents = list(database["cookies"].find({}))
+    cookies = sum(d["cookies"] for d in documents)
+    milk = sum(d.get("items", {}).get("Milk", 0) for d in documents)
+    print("cookies conserved: %s" % (cookies == users * 100))
+    print("items conserved: %s" % (milk == users * 5))
+    print("journal empty: %s" % (database["cookie_journal"].count_documents({}) == 0))
+    async_database.close()
+
+
+if __name__ == "__main__":
+    transfer_benchmark()
@@ -17,16 +17,16 @@ class Countdown(Plugin):
             self.countdown,  # main function
             subcommands=[],
         ).listen()  # sets the on message callbacks and parses messages
+        # countdowns are persisted, so they still finish after a restart
+        self.bot.scheduler.register("countdown.finish", self.finish)
 
-    def count_thread(self, timeobj, message, target):
-        time.sleep(timeobj.timestamp() - time.time())
-        self.bot.msg(target, message, follows=message)
+    def finish(self, target, message):
+        self.bot.msg(target, message)
 
     def countdown(self, message, *time_words, ping="Time's up"):
         timeobj = dateparser.parse(
             " ".join(time_words), settings={"PREFER_DATES_FROM": "future"}
         )
-        self.bot.util.thread(self.count_thread, (timeobj, ping, message.target))
         if time.time() > timeobj.timestamp():
             self.bot.msg(
                 message.target,
@@ -35,6 +35,9 @@ class Countdown(Plugin):
                 follows=message
             )
             return
+        self.bot.scheduler.schedule_at(
+            timeobj.timestamp(), "countdown.finish", target=message.target, message=ping
+        )
         self.bot.msg(
             message.target,
             "Ok, the timer will finish at %s"
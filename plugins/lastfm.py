@@ -5,6 +5,8 @@ from datetime import datetime
 
 
 class LastFm(Plugin):
+    indexes = {"lastfm": [[("discord_id", 1)]]}
+
     def __init__(self, bot):
         self.bot = bot
         if not "lastfm_key" in self.bot.config:
@@ -39,7 +41,7 @@ class LastFm(Plugin):
 
         self.api_key = self.bot.config["lastfm_key"]
         self.youtube_key = self.bot.config["youtube_key"]
-        self.db = self.bot.util.get_db()["lastfm"]
+        self.db = self.bot.util.get_async_db()["lastfm"]
         # self.bot.config["lastfm"]["api_secret"]
         lastfm = self
 
@@ -78,11 +80,11 @@ class LastFm(Plugin):
                 return "https://youtube.com/watch?v=" + video_id
         return "No results"
 
-    def fmyt(self, message, *keywords):
+    async def fmyt(self, message, *keywords):
         if len(keywords) > 0:
             track_name = " ".join(keywords)
         else:
-            user = self.get_user(message)
+            user = await self.get_user(message)
             track = self.get_nowplaying(user)
             track_name = track["name"]
         self.bot.msg(message.target, self.get_youtube(track_name), follows=message)
@@ -99,8 +101,8 @@ class LastFm(Plugin):
         )
         return recents["recenttracks"]["track"][0]
 
-    def fm(self, message, rhythm=False):
-        user = self.get_user(message)
+    async def fm(self, message, rhythm=False):
+        user = await self.get_user(message)
         track = self.get_nowplaying(user)
         self.bot.msg(
             message.target,
@@ -115,26 +117,28 @@ class LastFm(Plugin):
             follows=message,
         )
 
-    def link(self, message, username, *args):
-        current_user = self.db.find_one({"discord_id": message.author})
+    async def link(self, message, username, *args):
+        current_user = await self.db.find_one({"discord_id": message.author})
         if current_user:
-            self.db.update(
+            await self.db.update_one(
                 {"discord_id": message.author}, {"$set": {"lastfm_user": username}}
             )
         else:
-            self.db.insert_one({"discord_id": message.author, "lastfm_user": username})
+            await self.db.insert_one(
+                {"discord_id": message.author, "lastfm_user": username}
+            )
         self.bot.msg(message.target, "Account linked successfully!", follows=message)
 
-    def get_user(self, message):
-        user = self.db.find_one({"discord_id": message.author})
+    async def get_user(self, message):
+        user = await self.db.find_one({"discord_id": message.author})
         if user:
             return user
         else:
             raise self.NotRegistered(message.target)
 
-    def profile(self, message, username=False):
+    async def profile(self, message, username=False):
         if not username:
-            username = self.get_user(message)["lastfm_user"]
+            username = (await self.get_user(message))["lastfm_user"]
         user_info = json.loads(
             requests.get(
                 self.api_url
@@ -6,6 +6,11 @@ from taiiwobot.plugin import Plugin
 
 
 class Movie(Plugin):
+    indexes = {
+        "movie_watch_list": [[("l", 1)]],
+        "movie_requests": [[("l", 1), ("request_channel", 1)], [("requesters", 1)]],
+    }
+
     def __init__(self, bot):
         self.acceptable_qualities = ["HDRip", "HD", "720p"]
         self.bot = bot
@@ -38,7 +43,7 @@ class Movie(Plugin):
         ).listen()
         self.updated_db = False
         self.db_cache = False
-        bot.util.thread(self.loop)
+        self.loop_thread = bot.util.thread(self.loop, name="movie-watcher")
 
     def root(self, message, *args):
         self.interface.help(message.target, self)
@@ -57,7 +62,7 @@ class Movie(Plugin):
 
     def loop(self):
         # every one hour
-        while True:
+        while not self.bot.util.stopping():
             # check for movies
             for movie in self.get_watch_list():
                 quality, link = self.movie_available(movie)
@@ -78,7 +83,12 @@ class Movie(Plugin):
                             % (movie["l"], quality, mentions, link)
                         )
                     self.remove_from_watch_list(movie)
-            time.sleep(60 * 60)
+            if self.bot.util.sleep(60 * 60):
+                break
+
+    def unload(self):
+        super().unload()
+        self.loop_thread.stop()
 
     def watchlist(self, message):
         requests = self.db["movie_requests"].find(
@@ -112,10 +122,10 @@ class Movie(Plugin):
 
         def del_real(r, request):
             if len(request["requesters"]) == 1:
-                self.db["movie_requests"].remove(request)
+                self.db["movie_requests"].delete_one({"_id": request["_id"]})
             else:
-                self.db["movie_requests"].update(
-                    request, {"$pop": {"requesters": message.target}}
+                self.db["movie_requests"].update_one(
+                    {"_id": request["_id"]}, {"$pop": {"requesters": message.target}}
                 )
             self.bot.msg(
                 message.target,
@@ -253,8 +263,8 @@ class Movie(Plugin):
         if db_request:
             if requester in db_request["requesters"]:
                 return False
-            r = self.db["movie_requests"].update(
-                db_request, {"$push": {"requesters": requester}}
+            r = self.db["movie_requests"].update_one(
+                {"_id": db_request["_id"]}, {"$push": {"requesters": requester}}
             )
         else:
             r = self.db["movie_requests"].insert_one(request)
@@ -307,5 +317,5 @@ class Movie(Plugin):
 
     def remove_from_watch_list(self, movie):
         self.updated_db = True
-        self.db["movie_watch_list"].remove({"l": movie["l"]})
-        self.db["movie_requests"].remove({"l": movie["l"]})
+        self.db["movie_watch_list"].delete_many({"l": movie["l"]})
+        self.db["movie_requests"].delete_many({"l": movie["l"]})
@@ -48,6 +48,7 @@ class Reload(Plugin):
                     plugin.__module__ = "Plugin." + file[:-3]
                     # init the class and add it to the plugin list
                     if plugin:
+                        self.bot.migrate(plugin)
                         self.bot.plugins.append(plugin(self.bot))
                         self.bot.msg(message.target, "Plugin loaded!", follows=message)
                     else:
@@ -1,15 +1,424 @@
 import feedparser
-import pymongo
 import time
 import re
+import hashlib
+import calendar
+import functools
+import threading
+import asyncio
+import datetime
+import email.utils
+import xml.etree.ElementTree as ET
+from collections import deque, OrderedDict
+from concurrent.futures import as_completed
 from tomd import Tomd
 import html
 from bs4 import BeautifulSoup
 from taiiwobot.plugin import Plugin
-from dateutil import parser
+
+
+def post_time(entry):
+    # when an entry was posted as a unix time, or None if the feed doesn't say
+    t = entry.get("published_parsed") or entry.get("updated_parsed")
+    return calendar.timegm(t) if t else None
+
+
+def parse_condition(condition):
+    """Splits a condition into its clauses
+
+    Clauses are separated by ;, and look like key=pattern, pattern. Use \\;
+    \\= and \\, for literal characters.
+
+    Returns:
+        list: (key, [patterns]) for each clause
+
+    Raises:
+        ValueError: If a clause isn't key=pattern
+    """
+    clauses = []
+    for clause in re.split(r"(?<!\\);\s?", condition.strip()):
+        if not clause:
+            continue
+        m = re.match(r"^(.*?)(?<!\\)=(.*)$", clause)
+        if not m:
+            raise ValueError("`%s` should look like key=pattern" % clause)
+        key = m.group(1).strip().replace(r"\=", "=").replace(r"\;", ";")
+        clauses.append((key, re.split(r"(?<!\\),\s?", m.group(2))))
+    return clauses
+
+
+class Matcher:
+    """A destination's conditions, compiled
+
+    Every clause of every condition has to match the entry, and a clause
+    matches if any of its patterns do, so each clause is one alternation.
+
+    Args:
+        conditions (tuple): Condition strings
+
+    Raises:
+        ValueError: If a condition or pattern is invalid
+    """
+
+    def __init__(self, conditions):
+        self.clauses = []
+        for condition in conditions:
+            for key, patterns in parse_condition(condition):
+                if not key:
+                    continue
+                try:
+                    regex = re.compile("|".join("(?:%s)" % p for p in patterns))
+                except re.error as e:
+                    raise ValueError("Invalid pattern for %s: %s" % (key, e))
+                self.clauses.append((key, regex.search))
+
+    def __call__(self, entry):
+        for key, search in self.clauses:
+            value = entry.get(key)
+            if value is None or not search(value if type(value) == str else str(value)):
+                return False
+        return True
+
+
+@functools.lru_cache(maxsize=1024)
+def matcher(conditions):
+    # compiled once per set of conditions, shared by every destination using it
+    return Matcher(conditions)
+
+
+class Template:
+    """A destination's embed template, compiled
+
+    Templates are words separated by whitespace, and words starting with $
+    are replaced by that field of the entry. If any field is missing the
+    whole template renders as None.
+
+    Args:
+        text (str): The template, or None for an empty one
+    """
+
+    def __init__(self, text):
+        words = text.split() if text else []
+        self.fields = [w[1:] for w in words if w[0] == "$"]
+        # literal words are escaped, fields become {} slots
+        self.format = " ".join(
+            "{}" if w[0] == "$" else w.replace("{", "{{").replace("}", "}}")
+            for w in words
+        ).format
+
+    def render(self, entry):
+        try:
+            return self.format(*[entry[k] for k in self.fields])
+        except KeyError:
+            return None
+
+
+@functools.lru_cache(maxsize=4096)
+def template(text):
+    # compiled once per template text, shared by every destination using it
+    return Template(text)
+
+
+def render_entry(entry):
+    """Converts an entry to what every destination posts from, without changing it
+
+    The summary is parsed and turned into markdown once, however many
+    destinations the entry goes to.
+
+    Returns:
+        tuple: (the entry's fields with markdown summary and description,
+        the first image in the summary or None)
+    """
+    # find any images from within the summary and add them to the embed
+    soup = BeautifulSoup(entry.get("summary", ""), "html.parser")
+    image = None
+    for img in soup.find_all("img"):
+        if not image:
+            image = img.get("src")
+        img.decompose()
+    text = re.sub(r"<br ?/?>", "\n", str(soup))
+    text = re.sub(r"<!--.*-->", "", text)
+    # remove html formatting from the description
+    summary = html.unescape(
+        Tomd("<p>" + text.replace("%22", '"').replace("%3E", ">") + "</p>").markdown.strip()
+    )
+    summary = summary if summary != "" else text
+    # description is an alias
+    return dict(entry, summary=summary, description=summary), image
+
+
+def parse_date(text):
+    # rss uses rfc 822 dates, atom uses iso 8601. Returns a UTC struct_time
+    if not text:
+        return None
+    try:
+        date = email.utils.parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        try:
+            date = datetime.datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.utctimetuple()
+
+
+# rss channel elements and the names feedparser gives them
+channel_fields = {
+    "description": "subtitle",
+    "copyright": "rights",
+    "managingEditor": "author",
+    "webMaster": "publisher",
+    "pubDate": "published",
+    "lastBuildDate": "updated",
+}
+
+
+def stream_feed(chunks, seen, stop_after=3, limit=500):
+    """Parses an RSS or Atom feed as it downloads, newest entries first
+
+    Each entry is dropped from the tree once it's read, and only the first
+    and last limit entries are kept, so memory doesn't grow with the size of
+    the feed. Parsing stops after stop_after entries in a row that have been
+    seen before, or after limit entries, unless most dates so far go up, ie.
+    the feed looks sorted oldest first. Then it's read to the end and the
+    dates of the whole document decide which end the new entries are at.
+
+    Args:
+        chunks: The body of the response, in pieces
+        seen (SeenEntries): The entries already posted
+        limit (int, optional): Most entries kept
+
+    Returns:
+        dict: The feed in the same shape as feedparser's, with the fields
+        stream_feed understands, and the feed's skipHours
+
+    Raises:
+        xml.etree.ElementTree.ParseError: If the feed isn't well formed
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    result = {"feed": {}, "entries": [], "skip_hours": [], "bozo": 0}
+    # the open elements, and how deep the entries are
+    stack = []
+    entry_depth = None
+    in_a_row = 0
+    head = []
+    tail = deque(maxlen=limit)
+    # neighbouring dates that go up and down, one backdated entry can't
+    # outvote the rest of the feed
+    ascending = descending = 0
+    last_time = None
+    to_the_end = False
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            tag = element.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                stack.append(element)
+                if tag in ("item", "entry"):
+                    entry_depth = len(stack)
+                continue
+            stack.pop()
+            if tag in ("item", "entry") and len(stack) + 1 == entry_depth:
+                entry = stream_entry(element)
+                if stack:
+                    # forget it, so memory stays flat
+                    stack[-1].remove(element)
+                entry_depth = None
+                t = post_time(entry)
+                if t and last_time:
+                    ascending += t > last_time
+                    descending += t < last_time
+                last_time = t or last_time
+                if len(head) < limit:
+                    head.append(entry)
+                tail.append(entry)
+                if to_the_end:
+                    continue
+                in_a_row = in_a_row + 1 if seen.key(entry) in seen else 0
+                if in_a_row >= stop_after or len(head) >= limit:
+                    if ascending <= descending:
+                        result["entries"] = head
+                        return result
+                    # oldest first so far, the new entries would be at the end
+                    to_the_end = True
+            elif entry_depth is None and tag == "hour":
+                # like the feedparser path, hours that aren't numbers are skipped
+                hour = re.fullmatch(r"\s*(\d+)\s*", element.text or "")
+                if hour:
+                    result["skip_hours"].append(int(hour.group(1)))
+            elif (
+                entry_depth is None
+                and stack
+                and stack[-1].tag.rsplit("}", 1)[-1] in ("channel", "feed")
+            ):
+                # a field of the channel, eg. title or ttl
+                text = (element.text or "").strip()
+                if tag == "link" and element.get("href"):
+                    # atom links are attributes, only the alternate link counts
+                    if element.get("rel", "alternate") != "alternate":
+                        continue
+                    text = element.get("href")
+                elif tag == "author" and len(element):
+                    text = "".join(n.text or "" for n in element if n.tag.endswith("name"))
+                elif len(element):
+                    # eg. an rss image, feedparser doesn't make those text either
+                    continue
+                tag = channel_fields.get(tag, tag)
+                result["feed"].setdefault(tag, text)
+                if tag in ("published", "updated"):
+                    result["feed"].setdefault(tag + "_parsed", parse_date(text))
+    parser.close()
+    result["entries"] = list(tail) if ascending > descending else head
+    return result
+
+
+def stream_entry(element):
+    # the fields feedparser would give an entry, from an rss item or atom entry
+    fields = {}
+    for child in element:
+        tag = child.tag.rsplit("}", 1)[-1]
+        text = (child.text or "").strip()
+        if tag == "link":
+            # atom links are attributes, only the alternate link counts
+            if child.get("href") and child.get("rel", "alternate") == "alternate":
+                text = child.get("href")
+            elif child.get("href"):
+                continue
+        elif tag == "author" and len(child):
+            text = "".join(n.text or "" for n in child if n.tag.endswith("name"))
+        elif tag == "content":
+            # atom content can be xhtml elements rather than text
+            text = text or "".join(ET.tostring(n, encoding="unicode") for n in child)
+        fields.setdefault(tag, text)
+    # like feedparser, fields the entry doesn't have are left out
+    entry = {}
+    for key, sources in (
+        ("title", ["title"]),
+        ("link", ["link"]),
+        ("summary", ["description", "summary", "encoded", "content"]),
+        ("author", ["author", "creator"]),
+        ("comments", ["comments"]),
+    ):
+        value = next((fields[s] for s in sources if fields.get(s)), None)
+        if value:
+            entry[key] = value
+    if fields.get("guid") or fields.get("id"):
+        entry["id"] = fields.get("guid") or fields.get("id")
+    published = fields.get("pubDate") or fields.get("published") or fields.get("date")
+    if published:
+        entry["published"] = published
+        entry["published_parsed"] = parse_date(published)
+    if fields.get("updated"):
+        entry["updated"] = fields["updated"]
+        entry["updated_parsed"] = parse_date(fields["updated"])
+    return entry
+
+
+class SeenEntries:
+    """The entries of a feed that have already been posted, by GUID
+
+    The newest ids are kept exactly. Older ones age into a bloom filter of two
+    generations, and the oldest generation is dropped when the newest fills up,
+    so the state stays a few KB however long the feed runs. A generation holds
+    at least as many ids as the feed has entries, so nothing still in the feed
+    can be forgotten.
+
+    Args:
+        state (dict, optional): A state saved with state()
+    """
+
+    recent_size = 200
+    # ids per bloom generation, at 33 bits per id and 7 hashes about 1 in 100k
+    # unseen ids looks seen when it's full
+    capacity = 500
+    bits_per_id = 33
+    hashes = 7
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.recent = deque(state.get("recent", []))
+        self.recent_set = set(self.recent)
+        self.capacity = state.get("capacity", self.capacity)
+        self.generations = [bytearray(b) for b in state.get("bloom", [])] or [
+            self.generation(),
+            self.generation(),
+        ]
+        self.count = state.get("count", 0)
+        # whether state() differs from the state it was loaded from
+        self.changed = False
+
+    def generation(self):
+        # an empty bloom filter for the current capacity, whole bytes
+        return bytearray(-(-self.capacity * self.bits_per_id // 8))
+
+    def fit(self, entries):
+        """Makes sure a feed of this many entries is remembered whole
+
+        Growing starts a larger generation and keeps the old ones until the
+        next rotation, which then drops back to two.
+        """
+        if entries > self.capacity:
+            self.capacity = entries
+            self.generations.insert(0, self.generation())
+            self.count = 0
+            self.changed = True
+
+    @staticmethod
+    def key(entry):
+        guid = entry.get("id") or entry.get("link") or "%s %s" % (
+            entry.get("title", ""),
+            entry.get("published", ""),
+        )
+        return hashlib.sha1(guid.encode()).hexdigest()[:16]
+
+    def positions(self, key, bits):
+        # double hashing, two 32 bit halves of the key make every position
+        h = int(key, 16)
+        h1, h2 = h >> 32, (h & 0xFFFFFFFF) | 1
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        if key in self.recent_set:
+            return True
+        return any(
+            all(g[p >> 3] & (1 << (p & 7)) for p in self.positions(key, len(g) * 8))
+            for g in self.generations
+        )
+
+    def add(self, key):
+        if key in self.recent_set:
+            return
+        self.changed = True
+        self.recent.append(key)
+        self.recent_set.add(key)
+        if len(self.recent) > self.recent_size:
+            old = self.recent.popleft()
+            self.recent_set.discard(old)
+            if self.count >= self.capacity:
+                # forget the oldest generation
+                self.generations = [self.generation(), self.generations[0]]
+                self.count = 0
+            newest = self.generations[0]
+            for p in self.positions(old, len(newest) * 8):
+                newest[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def state(self):
+        return {
+            "recent": list(self.recent),
+            "bloom": [bytes(g) for g in self.generations],
+            "count": self.count,
+            "capacity": self.capacity,
+        }
 
 
 class RSS(Plugin):
+    indexes = {
+        "rss_feeds": [[("url", 1)], [("next_poll", 1)]],
+        "rss_destinations": [[("target", 1)], [("feed_id", 1)]],
+    }
+
     def __init__(self, bot):
         self.bot = bot
         self.interface = bot.util.Interface(
@@ -24,6 +433,7 @@ class RSS(Plugin):
                     [
                         "t target The target channel the feed updates will appear in 1",
                         'c conditions Filter keys with a regex. Eg: `-c="title=weather; desc=UK` to only post entries with "weather" in the title, and "UK" in the description 1',
+                        "r refresh Download the feed again instead of using the last copy 0",
                     ],
                     self.add,
                 ),
@@ -43,6 +453,7 @@ class RSS(Plugin):
                         "c conditions Show the condition editing menu 0",
                         "cc create-condition Specify a condition to create 0",
                         "dc delete-condition Delete a condition 0",
+                        "r refresh Download the feed again instead of using the last copy 0",
                     ],
                     self.edit,
                 ),
@@ -51,6 +462,12 @@ class RSS(Plugin):
 
         self.db = self.bot.util.get_db()
         self.feeds_col = self.db["rss_feeds"]
+        # where each feed is posted, {feed_id, target, keys, conditions}
+        self.destinations_col = self.db["rss_destinations"]
+        # awaitable versions for use from commands
+        self.async_feeds_col = self.bot.util.get_async_db()["rss_feeds"]
+        self.async_destinations_col = self.bot.util.get_async_db()["rss_destinations"]
+        self.migrate_destinations()
         self.default_settings = {
             "message": None,
             "title": "$title",
@@ -63,15 +480,27 @@ class RSS(Plugin):
             "author_icon": None,
             "color": "0xbade83",
         }
-        self.stopped = False
-        self.loop_thread = self.bot.util.thread(self.loop)
+        # seconds between polls of a feed we know nothing about yet, the
+        # bounds for the rest, and how the last poll went
+        self.interval = 60 * 10
+        self.min_interval = self.bot.config.get("rss_min_interval", 60)
+        self.max_interval = self.bot.config.get("rss_max_interval", 60 * 60 * 24)
+        self.last_cycle = None
+        # feeds bigger than this are parsed as they stream in
+        self.stream_threshold = self.bot.config.get("rss_stream_threshold", 1024 * 1024)
+        # the last parsed copy of recently polled feeds, {url: feed}, for the
+        # samples in the add and edit menus
+        self.snapshots = OrderedDict()
+        self.snapshot_size = 64
+        self.snapshot_lock = threading.Lock()
+        self.loop_thread = self.bot.util.thread(self.loop, name="rss-poller")
 
     def root(self, message):
         # self.bot.msg(message.target, "%s %s %s" % (output, force, quiet))
         self.interface.help(message.target, self)
 
     @Plugin.authenticated
-    def add(self, message, url, target="", conditions=""):
+    async def add(self, message, url, target="", conditions="", refresh=False):
         if not url:
             raise self.bot.util.RuntimeError(
                 "Missing argument: url. Usage: $rss add [flags] <url>",
@@ -81,7 +510,7 @@ class RSS(Plugin):
         # parse the input values
         target = target if target else message.target
         target = target if type(target) == int else int(target)
-        existing_feed = self.feeds_col.find_one({"url": url})
+        existing_feed = await self.async_feeds_col.find_one({"url": url})
         if url[:7] not in ["https:/", "http://"]:
             raise self.bot.util.RuntimeError(
                 "`url` must be a valid URL meaning it must start with http:// "
@@ -89,7 +518,8 @@ class RSS(Plugin):
                 message.target,
                 self,
             )
-        feed_sample = feedparser.parse(url)
+        self.check_conditions([conditions], message.target)
+        feed_sample = await self.sample(url, message.target, refresh)
         if len(feed_sample["entries"]) < 1:
             raise self.bot.util.RuntimeError(
                 "This does not appear to be a valid feed. "
@@ -98,28 +528,31 @@ class RSS(Plugin):
                 self,
             )
         if existing_feed:
-            for destination in existing_feed["destinations"]:
-                if target == destination["target"]:
-                    raise self.bot.util.RuntimeError(
-                        "That feed is already being tracked in this channel! "
-                        "To edit the way that feed is managed, type: `%s edit`"
-                        "To remove that feed, type `%s remove <url>`"
-                        % (
-                            self.interface.prefix + self.interface.name,
-                            self.interface.prefix + self.interface.name,
-                        ),
-                        message.target,
-                        self,
-                    )
+            if await self.async_destinations_col.find_one(
+                {"feed_id": existing_feed["_id"], "target": target}
+            ):
+                raise self.bot.util.RuntimeError(
+                    "That feed is already being tracked in this channel! "
+                    "To edit the way that feed is managed, type: `%s edit`"
+                    "To remove that feed, type `%s remove <url>`"
+                    % (
+                        self.interface.prefix + self.interface.name,
+                        self.interface.prefix + self.interface.name,
+                    ),
+                    message.target,
+                    self,
+                )
             feed = existing_feed
         else:
-            post_times = sorted(
-                [parser.parse(e["updated"]) for e in feed_sample["entries"]]
-            )
+            # everything already in the feed counts as posted
+            seen = SeenEntries()
+            seen.fit(len(feed_sample["entries"]))
+            # oldest first, so the newest end up in the exact set
+            for e in reversed(feed_sample["entries"]):
+                seen.add(seen.key(e))
             feed = {
                 "url": url,
-                "latest_post": post_times[-1],
-                "destinations": [],
+                "seen": seen.state(),
             }
         destination = {
             "target": target,
@@ -131,27 +564,35 @@ class RSS(Plugin):
         # post a sample of the feed
         self.post_entry(
             {"target": message.target, "keys": "default", "conditions": [conditions],},
-            entry,
+            render_entry(entry),
         )
         # callback function for if the user hits "yes" in the following menu
-        def yes(r):
+        async def yes(r):
             # the user decided the feed looked good
-            if existing_feed:
-                # edit the existing feed
-                self.feeds_col.update(
-                    existing_feed, {"$push": {"destinations": destination}}
-                )
-            else:
-                # insert a new feed into the db
-                feed["destinations"].append(destination)
-                self.feeds_col.insert_one(feed)
+            if "_id" not in feed:
+                # insert a new feed into the db, unless it was added meanwhile
+                tracked = await self.async_feeds_col.find_one({"url": url}, {"url": True})
+                if tracked:
+                    feed["_id"] = tracked["_id"]
+                else:
+                    await self.async_feeds_col.insert_one(feed)
+            destination["feed_id"] = feed["_id"]
+            await self.async_destinations_col.update_one(
+                {"feed_id": feed["_id"], "target": target},
+                {"$set": destination},
+                upsert=True,
+            )
+
+        async def yes_and_edit(r):
+            await yes(r)
+            await self.edit(message, url)
 
         # ask the user if it needs editing
         self.bot.menu(
             message.target,
             message.author_id,
             "Does this look okay?",
-            ync=[yes, lambda r: yes(r) + self.edit(message, url), lambda r: None],
+            ync=[yes, yes_and_edit, lambda r: None],
         )
 
     @Plugin.authenticated
@@ -165,17 +606,21 @@ class RSS(Plugin):
             )
         target = target if target else message.target
         target = target if type(target) == int else int(target)
-        feed = self.feeds_col.find_one({"url": url})
-        # if this is the only place the feed is used
-        if len(feed["destinations"]) == 1:
+        feed = self.feeds_col.find_one({"url": url}, {"url": True})
+        if not feed or not self.destinations_col.delete_many(
+            {"feed_id": feed["_id"], "target": target}
+        ).deleted_count:
+            raise self.bot.util.RuntimeError(
+                "That feed isn't being tracked there.", message.target, self
+            )
+        # if this was the only place the feed is used
+        if not self.destinations_col.count_documents({"feed_id": feed["_id"]}):
             # remove the whole feed
-            self.feeds_col.remove(feed)
-        else:
-            # delete this destination
-            self.feeds_col.update(feed, {"$pull": {"destination": {"target": target}}})
+            self.feeds_col.delete_one({"_id": feed["_id"]})
+        self.bot.msg(message.target, "The feed has been removed.")
 
     @Plugin.authenticated
-    def edit(
+    async def edit(
         self,
         message,
         url=None,
@@ -186,12 +631,21 @@ class RSS(Plugin):
         create_condition=False,
         edit_condition=None,
         delete_condition=None,
+        refresh=False,
     ):
         # sanitize user input
         target = target if target else message.target
         target = target if type(target) == int else int(target)
+        if refresh and url:
+            # the next sample in this edit downloads the feed again
+            self.forget(url)
         if not url:
-            urls = self.feeds_col.find({"destinations.target": target}, {"url": True})
+            feed_ids = [
+                d["feed_id"]
+                for d in await self.async_destinations_col.find(
+                    {"target": target}, {"feed_id": True}
+                )
+            ]
             # array of arrays: answer, function
             def lambda_factory(u):
                 return lambda r: self.edit(
@@ -200,7 +654,9 @@ class RSS(Plugin):
 
             answers = [
                 [u["url"], lambda_factory(u)]
-                for u in self.feeds_col.find({"destinations.target": target})
+                for u in await self.async_feeds_col.find(
+                    {"_id": {"$in": feed_ids}}, {"url": True}
+                )
             ]
             self.bot.menu(
                 message.target,
@@ -210,16 +666,18 @@ class RSS(Plugin):
             )
             return
         # get the feed
-        feed = self.feeds_col.find_one({"url": url})
-        if not feed:
+        feed = await self.async_feeds_col.find_one({"url": url}, {"url": True})
+        # get the destination
+        destination = feed and await self.async_destinations_col.find_one(
+            {"feed_id": feed["_id"], "target": target}
+        )
+        if not destination:
             raise self.bot.util.RuntimeError(
                 "That feed is not currently being tracked. If you meant to add"
                 "it use $rss add <url>",
                 message.target,
                 self,
             )
-        # get the destination
-        destination = [f for f in feed["destinations"] if f["target"] == target][0]
         # which menu is being requested
         if formatting:
             keys = (
@@ -242,8 +700,8 @@ class RSS(Plugin):
             )
         elif edit_attribute:
             # build a set of example entry variables to choose from
-            sample_feed = feedparser.parse(feed["url"])
-            sample_entry = sample_feed["entries"][0]
+            sample_feed = await self.sample(feed["url"], message.target)
+            sample_entry = self.first_entry(sample_feed, message.target)
             # remove redundant data
             del sample_feed["entries"]
             sample_entry.update({"feed:" + k: v for k, v in sample_feed.items()})
@@ -268,19 +726,20 @@ class RSS(Plugin):
             def confirm(m):
                 value = m.content
                 d = destination.copy()
-                if d["keys"] == "default":
-                    d["keys"] = self.default_settings
+                # a copy, so the defaults and the sample stay as they were
+                d["keys"] = dict(
+                    self.default_settings if d["keys"] == "default" else d["keys"]
+                )
                 d["keys"][edit_attribute] = value
                 sample_d = d.copy()
                 sample_d["target"] = message.target
                 # post an example for the user to validate
-                self.post_entry(sample_d, sample_entry)
+                self.post_entry(sample_d, render_entry(sample_entry))
                 # if the users says yes
-                def yes(r):
+                async def yes(r):
                     # write the new destination to the database
-                    self.feeds_col.update(
-                        {"url": url, "destinations.target": target},
-                        {"$set": {"destinations.$": d}},
+                    await self.async_destinations_col.update_one(
+                        {"_id": destination["_id"]}, {"$set": {"keys": d["keys"]}}
                     )
                     # print complete message
                     self.bot.msg(message.target, "Changed have been made.")
@@ -330,7 +789,9 @@ class RSS(Plugin):
             )
         elif create_condition:
             # build a set of example entry variables to choose from
-            sample_entry = feedparser.parse(feed["url"])["entries"][0]
+            sample_entry = self.first_entry(
+                await self.sample(feed["url"], message.target), message.target
+            )
             msg = (
                 "Here's a sample of the data each feed entry has available:\n\n"
                 "```\n%s\n```"
@@ -344,12 +805,10 @@ class RSS(Plugin):
             )
             self.bot.msg(message.target, msg)
 
-            def append_condition(condition):
-                print(condition)
-                condict = self.parse_condition(condition)
-                self.feeds_col.update(
-                    {"url": url, "destinations.target": target},
-                    {"$push": {"destinations.$.conditions": condition}},
+            async def append_condition(condition):
+                self.check_conditions([condition], message.target)
+                await self.async_destinations_col.update_one(
+                    {"_id": destination["_id"]}, {"$push": {"conditions": condition}}
                 )
                 self.bot.msg(
                     message.target, "Your condition has been added to the feed."
@@ -366,22 +825,21 @@ class RSS(Plugin):
             )
         elif delete_condition:
 
-            def delete_condition_f(condition):
-                r = self.feeds_col.update(
-                    {"url": url, "destinations.target": target},
-                    {"$pull": {"destinations.$.conditions": condition}},
+            async def delete_condition_f(condition):
+                await self.async_destinations_col.update_one(
+                    {"_id": destination["_id"]}, {"$pull": {"conditions": condition}}
                 )
                 self.bot.msg(message.target, "Condition deleted.")
 
             # ask them which condition they want to delete
-            for destination in feed["destinations"]:
-                if destination["target"] == target:
-                    conditions = destination["conditions"]
             self.bot.menu(
                 message.target,
                 message.author,
                 "Select the condition you'd like to delete: ",
-                [[c, lambda r: delete_condition_f(c)] for c in conditions],
+                [
+                    [c, lambda r, c=c: delete_condition_f(c)]
+                    for c in destination["conditions"]
+                ],
             )
 
         else:
@@ -402,65 +860,93 @@ class RSS(Plugin):
                 ],
             )
 
-    # parses a post condition string
-    def parse_condition(self, condition):
-        if condition == "":
-            return None
-        # split by any ;<space>
-        conditions = re.split(r"[^\\];\s?", condition)
-        ret = {}
-        for c in conditions:
-            # Basically splits by =, allowing for \=
-            m = re.match(r"^(.+[^\\])=(.*)", c)
-            key = m.group(1).replace(r"\=", "=")
-            ret[key] = re.split(r",\s?", m.group(2))
-        return ret
-
-    def post_entry(self, destination, entry):
+    def migrate_destinations(self):
+        # destinations used to be embedded in their feed's document
+        for feed in self.feeds_col.find({"destinations": {"$exists": True}}):
+            for destination in feed["destinations"]:
+                self.destinations_col.update_one(
+                    {"feed_id": feed["_id"], "target": destination["target"]},
+                    {"$set": dict(destination, feed_id=feed["_id"])},
+                    upsert=True,
+                )
+            self.feeds_col.update_one({"_id": feed["_id"]}, {"$unset": {"destinations": ""}})
+
+    def remember(self, url, f):
+        # keeps a copy of a parsed feed, without the entries being posted from it
+        if not f.get("entries"):
+            # a broken or empty poll shouldn't replace a useful copy
+            return
+        with self.snapshot_lock:
+            self.snapshots[url] = dict(f, entries=list(f.get("entries", [])))
+            self.snapshots.move_to_end(url)
+            while len(self.snapshots) > self.snapshot_size:
+                self.snapshots.popitem(last=False)
+
+    def forget(self, url):
+        with self.snapshot_lock:
+            self.snapshots.pop(url, None)
+
+    async def sample(self, url, target, refresh=False):
+        """The last parsed copy of a feed, downloaded if there isn't one
+
+        Returns:
+            dict: A copy of the parsed feed, safe to change
+        """
+        with self.snapshot_lock:
+            snapshot = None if refresh else self.snapshots.get(url)
+            if snapshot:
+                self.snapshots.move_to_end(url)
+        if not snapshot:
+            try:
+                snapshot, cache = await asyncio.wrap_future(
+                    self.bot.util.get_http().submit(url, self.fetch, {"url": url})
+                )
+            except Exception as e:
+                raise self.bot.util.RuntimeError(
+                    "Couldn't download that feed: %s" % e, target, self
+                )
+            self.remember(url, snapshot)
+        return dict(snapshot, entries=[dict(e) for e in snapshot.get("entries", [])])
+
+    def first_entry(self, sample, target):
+        # the entry shown as an example
+        if not sample["entries"]:
+            raise self.bot.util.RuntimeError(
+                "That feed doesn't have any entries to show right now. "
+                "Try again later, or with -r to download it again.",
+                target,
+                self,
+            )
+        return sample["entries"][0]
+
+    def check_conditions(self, conditions, target):
+        # reject conditions that can't be matched before they're saved
+        try:
+            matcher(tuple(conditions))
+        except ValueError as e:
+            raise self.bot.util.RuntimeError(
+                "That condition is invalid: %s" % e, target, self
+            )
+
+    def post_entry(self, destination, rendered):
+        """Posts an entry made by render_entry() to a destination"""
+        entry, image = rendered
         keys = (
             self.default_settings
             if destination["keys"] == "default"
             else destination["keys"]
         )
-        # find any images from within the summary and add them to the embed
-        soup = BeautifulSoup(entry["summary"], "html.parser")
-        imgs = soup.find_all("img")
-        image = None
-        for img in imgs:
-            if not image:
-                image = img["src"]
-            img.decompose()
-        entry["summary"] = re.sub(r"<br ?/?>", "\n", str(soup))
-        entry["summary"] = re.sub(r"<!--.*-->", "", entry["summary"])
-        # remove html formatting from the description
-        print(entry["summary"])
-        summary = html.unescape(
-            Tomd(
-                "<p>"
-                + entry["summary"].replace("%22", '"').replace("%3E", ">")
-                + "</p>"
-            ).markdown.strip()
-        )
-        entry["summary"] = summary if summary != "" else entry["summary"]
-        entry["description"] = entry["summary"]  # alias
         # turns a key format into value string
         def format_key(t):
-            v = []
-            # for each word in the value of the key if value exists
-            for k in keys[t].split() if t in keys and keys[t] else []:
-                if k[0] == "$":
-                    v.append(entry[k[1:]] if k[1:] in entry else None)
-                else:
-                    v.append(k)
-            # if we're missing any of the values, display nothing
-            return " ".join(v) if not None in v else None
+            return template(keys.get(t)).render(entry)
 
+        desc = format_key("desc")
         return self.bot.msg(
             destination["target"],
             format_key("message") + " ",
             embed=self.bot.server.embed(
                 title=format_key("title"),
-                desc=format_key("desc")[:2047],
+                desc=desc[:2047] if desc else desc,
                 author_name=format_key("author_name"),
                 author_link=format_key("author_link"),
                 author_icon=format_key("author_icon"),
@@ -471,61 +957,378 @@ class RSS(Plugin):
             ),
         )
 
+    def fetch(self, feed, stream=True):
+        """Downloads and parses a feed, unless it hasn't changed since last time
+
+        Runs on a fetch thread, so a slow feed never holds up the others.
+        Feeds over stream_threshold bytes are parsed as they download, and
+        only until the entries already seen.
+
+        Returns:
+            tuple: (the parsed feed or None if unchanged, cache fields to save)
+        """
+        headers = {}
+        if feed.get("etag"):
+            headers["If-None-Match"] = feed["etag"]
+        if feed.get("modified"):
+            headers["If-Modified-Since"] = feed["modified"]
+        response = self.bot.util.get_http().get(
+            feed["url"], headers=headers, stream=True
+        )
+        max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        cache = {"max_age": int(max_age.group(1)) if max_age else None}
+        if response.status_code == 304:
+            response.close()
+            return None, {k: v for k, v in cache.items() if feed.get(k) != v}
+        response.raise_for_status()
+        cache["etag"] = response.headers.get("ETag")
+        cache["modified"] = response.headers.get("Last-Modified")
+        size = int(response.headers.get("Content-Length") or 0)
+        # "stream" is False for feeds that aren't well formed enough to stream
+        streamable = stream and feed.get("stream", True)
+        if streamable and (feed.get("large") or size > self.stream_threshold):
+            try:
+                with response:
+                    f = stream_feed(
+                        response.iter_content(64 * 1024), SeenEntries(feed.get("seen"))
+                    )
+            except ET.ParseError:
+                # not well formed xml, feedparser copes better. Remember that,
+                # or every poll would download it twice
+                f, cache = self.fetch(feed, stream=False)
+                cache["stream"] = False
+                return f, cache
+            # the whole body is rarely read, so there's no hash to compare
+            cache["large"] = True
+            cache = {k: v for k, v in cache.items() if feed.get(k) != v}
+            skip_hours = f["skip_hours"]
+        else:
+            cache["content_hash"] = hashlib.sha1(response.content).hexdigest()
+            cache["large"] = len(response.content) > self.stream_threshold
+            # only what changed needs saving
+            cache = {k: v for k, v in cache.items() if feed.get(k) != v}
+            if "content_hash" not in cache:
+                # the server ignored the conditional request, but nothing changed
+                return None, cache
+            headers = {k.lower(): v for k, v in response.headers.items()}
+            # lets feedparser resolve relative links against the final url
+            headers["content-location"] = response.url
+            f = feedparser.parse(response.content, response_headers=headers)
+            if feed.get("stream") is False and not f.get("bozo"):
+                # fixed since it failed to stream, so it can be streamed again
+                cache["stream"] = True
+            skip_hours = re.search(rb"<skipHours>(.*?)</skipHours>", response.content, re.S)
+            skip_hours = (
+                [int(h) for h in re.findall(rb"<hour>\s*(\d+)\s*</hour>", skip_hours.group(1))]
+                if skip_hours
+                else None
+            )
+        # the publisher's hints about how often to poll
+        ttl = f.get("feed", {}).get("ttl")
+        hints = {
+            "ttl": int(ttl) * 60 if ttl and ttl.strip().isdigit() else None,
+            "skip_hours": sorted({h % 24 for h in skip_hours}) if skip_hours else None,
+        }
+        cache.update({k: v for k, v in hints.items() if feed.get(k) != v})
+        return f, cache
+
     def loop(self):
-        while not self.stopped:
-            print("checking for feeds")
-            for feed in self.feeds_col.find({}):
-                f = feedparser.parse(feed["url"])
-                if "entries" not in f:
-                    # could not get feed. Disconnected from the internet?
+        while not self.bot.util.stopping():
+            start = time.time()
+            http = self.bot.util.get_http()
+            # only the feeds that are due, new feeds don't have a time yet
+            feeds = list(
+                self.feeds_col.find(
+                    {
+                        "$or": [
+                            {"next_poll": {"$lte": start}},
+                            {"next_poll": {"$exists": False}},
+                        ]
+                    }
+                )
+            )
+            # where each of them is posted, in one query
+            destinations = {}
+            for d in self.destinations_col.find(
+                {"feed_id": {"$in": [feed["_id"] for feed in feeds]}}
+            ):
+                destinations.setdefault(d["feed_id"], []).append(d)
+            for feed in feeds:
+                feed["destinations"] = destinations.get(feed["_id"], [])
+            # fetch and parse every feed at once, post them as they arrive
+            futures = {http.submit(feed["url"], self.fetch, feed): feed for feed in feeds}
+            failed = unchanged = 0
+            for future in as_completed(futures):
+                feed = futures[future]
+                try:
+                    f, fields = future.result()
+                    if f is None:
+                        unchanged += 1
+                    else:
+                        self.remember(feed["url"], f)
+                        fields.update(self.update_feed(feed, f))
+                    fields["failures"] = 0
+                except Exception as e:
+                    failed += 1
+                    fields = {"failures": feed.get("failures", 0) + 1}
+                    self.bot.util.debug("[W] Couldn't update %s: %r" % (feed["url"], e))
+                fields["next_poll"] = self.next_poll(dict(feed, **fields), time.time())
+                self.feeds_col.update_one({"_id": feed["_id"]}, {"$set": fields})
+            self.last_cycle = {
+                "feeds": len(feeds),
+                "failed": failed,
+                "unchanged": unchanged,
+                "seconds": time.time() - start,
+            }
+            if feeds:
+                self.bot.util.debug(
+                    "[I] Checked %s RSS feeds in %.1fs, %s unchanged, %s failed"
+                    % (len(feeds), self.last_cycle["seconds"], unchanged, failed)
+                )
+            # sleep until the next feed is due, but look for new feeds now and then
+            upcoming = self.feeds_col.find_one(
+                {"next_poll": {"$exists": True}}, {"next_poll": True}, sort=[("next_poll", 1)]
+            )
+            wake = start + self.min_interval
+            if upcoming and upcoming["next_poll"] < wake:
+                wake = upcoming["next_poll"]
+            if self.bot.util.sleep(wake - time.time()):
+                break
+
+    def next_poll(self, feed, now):
+        """Works out when to poll a feed again
+
+        Aims for about two polls per post, using the average time between
+        posts, never sooner than the feed's ttl or Cache-Control asks for, and
+        always within rss_min_interval and rss_max_interval.
+        """
+        if feed.get("failures"):
+            # back off while a feed is broken
+            delay = self.min_interval * 2 ** feed["failures"]
+        elif feed.get("post_interval"):
+            # a feed that has been quiet for longer than usual is slowing down
+            quiet = now - feed.get("last_post_time", now)
+            delay = max(feed["post_interval"], quiet) / 2
+        else:
+            delay = self.interval
+        delay = max(delay, feed.get("ttl") or 0, feed.get("max_age") or 0)
+        due = now + min(max(delay, self.min_interval), self.max_interval)
+        # skipHours are in GMT
+        skip_hours = feed.get("skip_hours") or []
+        for i in range(24):
+            if time.gmtime(due).tm_hour not in skip_hours:
+                break
+            due = (due // 3600 + 1) * 3600
+        return min(due, now + self.max_interval)
+
+    def update_feed(self, feed, f):
+        """Posts the new entries of a parsed feed
+
+        Returns:
+            dict: Fields of the feed to update
+        """
+        if "entries" not in f:
+            # could not get feed. Disconnected from the internet?
+            return {}
+        seen = SeenEntries(feed.get("seen"))
+        seen.fit(len(f["entries"]))
+        entries = []
+        for entry in f["entries"]:
+            key = seen.key(entry)
+            if key in seen:
+                continue
+            seen.add(key)
+            if "seen" not in feed and "latest_post" in feed:
+                # tracked before guids were, so the dates decide one last time
+                t = post_time(entry)
+                if not t or t <= calendar.timegm(feed["latest_post"].timetuple()):
                     continue
-                entries = []
-                latest_post = feed["latest_post"]
-                for entry in f["entries"]:
-                    if (
-                        parser.parse(entry["updated"], ignoretz=True)
-                        > feed["latest_post"]
-                    ):
-                        entries.append(entry)
-                        if parser.parse(entry["updated"], ignoretz=True) > latest_post:
-                            latest_post = parser.parse(entry["updated"], ignoretz=True)
-                # if there are no new entries
-                if len(entries) == 0:
-                    # no new articles, go to next feed
+            entries.append(entry)
+        # the state is a few KB, only write it when something was added
+        fields = {"seen": seen.state()} if seen.changed else {}
+        # learn how often the feed posts, from all of it the first time
+        fields.update(
+            self.post_interval(
+                feed,
+                sorted(
+                    t
+                    for t in map(
+                        post_time,
+                        entries if "last_post_time" in feed else f["entries"],
+                    )
+                    if t
+                ),
+            )
+        )
+        # if there are no new entries
+        if len(entries) == 0:
+            # no new articles, go to next feed
+            return fields
+        # mark them seen before posting, a crash should never post them twice
+        self.feeds_col.update_one({"_id": feed["_id"]}, {"$set": fields})
+        # remove entry list from the feed to save resources
+        del f["entries"]
+        # for each new entry
+        for entry in entries:
+            # add some of the feed keys for use in markup
+            entry.update({"feed:" + k: v for k, v in f.items()})
+            rendered = None
+            for destination in feed["destinations"]:
+                # run the conditions against the entry
+                try:
+                    match = matcher(tuple(destination["conditions"]))(entry)
+                except ValueError as e:
+                    # saved before conditions were checked, post everything
+                    self.bot.util.debug("[W] Bad condition for %s: %s" % (feed["url"], e))
+                    match = True
+                if not match:
+                    # entry does not match the conditions for this dest
                     continue
-                # remove entry list from the feed to save resources
-                del f["entries"]
-                # for each new entry
-                for entry in entries:
-                    # add some of the feed keys for use in markup
-                    entry.update({"feed:" + k: v for k, v in f.items()})
-                    # print(entry["title"])
-                    for destination in feed["destinations"]:
-                        # run the conditions against the entry
-                        if destination["conditions"]:
-                            for conditions in destination["conditions"]:
-                                match = False
-                                condict = self.parse_condition(conditions)
-                                if not condict:
-                                    # conditions were invalid, set match to true
-                                    # but also evaluate the other conditions
-                                    match = True
-                                    continue
-                                for key, condition in condict.items():
-                                    for cond in condition:
-                                        if key == "" or re.search(cond, entry[key]):
-                                            match = True
-                                            break
-                        else:
-                            # default to true if there are no conditions
-                            match = True
-                        if not match:
-                            # entry does not match the conditions for this dest
-                            continue
-                        self.post_entry(destination, entry)
-                self.feeds_col.update(feed, {"$set": {"latest_post": latest_post}})
-            time.sleep(60 * 10)
+                # rendered once, the first time a destination wants it
+                rendered = rendered or render_entry(entry)
+                self.post_entry(destination, rendered)
+        return {}
+
+    def post_interval(self, feed, post_times):
+        # learns the average time between posts from new posts' timestamps
+        interval = feed.get("post_interval")
+        last = feed.get("last_post_time")
+        times = ([last] if last else []) + post_times
+        if not times:
+            return {}
+        for a, b in zip(times, times[1:]):
+            gap = max(b - a, 0)
+            # an exponentially weighted average, recent gaps count the most
+            interval = gap if interval is None else 0.3 * gap + 0.7 * interval
+        fields = {"last_post_time": max(times)}
+        if interval is not None:
+            fields["post_interval"] = interval
+        return fields
 
     def unload(self):
         super().unload()
-        self.stopped = True
+        self.loop_thread.stop()
+
+
+def seen_entries_check(entries=1300, polls=5, new=400):
+    """Checks that a feed larger than a bloom generation is remembered whole
+
+    Seeds the feed like add does, then polls it a few times with new entries
+    on top, saving and loading the state in between like the database does
+    """
+    feed = [{"id": "entry %s" % i} for i in range(entries)]
+    seen = SeenEntries()
+    seen.fit(len(feed))
+    for e in reversed(feed):
+        seen.add(seen.key(e))
+    reposted = 0
+    for poll in range(polls):
+        feed = [{"id": "poll %s entry %s" % (poll, i)} for i in range(new)] + feed
+        feed = feed[: entries + new]
+        seen = SeenEntries(seen.state())
+        seen.fit(len(feed))
+        fresh = [e for e in feed if seen.key(e) not in seen]
+        reposted += len(fresh) - new
+        for e in fresh:
+            seen.add(seen.key(e))
+    false_positives = sum(
+        SeenEntries.key({"id": "never %s" % i}) in seen for i in range(100000)
+    )
+    print(
+        "feed of %s: %s entries reposted, %s in 100000 unseen ids look seen, %s KB"
+        % (
+            len(feed),
+            reposted,
+            false_positives,
+            sum(len(g) for g in seen.state()["bloom"]) // 1024,
+        )
+    )
+
+
+def stream_order_check(items=2001, seen_count=500):
+    """Checks that streaming finds the new entries at the right end of a feed
+
+    The newest-first feed has a backdated second item, which used to make the
+    whole feed look oldest first and post its oldest entries instead
+    """
+
+    def feed(order, backdate):
+        dates = {i: 1.7e9 + i * 60 for i in range(items)}
+        # the second newest is backdated by two hours
+        dates[items - 2] -= backdate
+        body = "".join(
+            "<item><guid>g%s</guid><pubDate>%s</pubDate></item>"
+            % (i, email.utils.formatdate(dates[i], usegmt=True))
+            for i in order
+        )
+        return [("<rss><channel><title>t</title>%s</channel></rss>" % body).encode()]
+
+    for name, order in (
+        ("newest first", range(items - 1, -1, -1)),
+        ("oldest first", range(items)),
+    ):
+        seen = SeenEntries()
+        # everything but the newest was posted before
+        for i in range(items - 1 - seen_count, items - 1):
+            seen.add(seen.key({"id": "g%s" % i}))
+        f = stream_feed(feed(order, 2 * 60 * 60), seen)
+        new = [e["id"] for e in f["entries"] if seen.key(e) not in seen]
+        print(
+            "%s with a backdated entry: %s kept, %s new %s (expected g%s)"
+            % (name, len(f["entries"]), len(new), new[:3], items - 1)
+        )
+
+
+def template_benchmark(renders=100000):
+    """Compares compiled templates with splitting the template for every field"""
+    settings = {
+        "title": "$title",
+        "desc": "$description",
+        "footer": "published at $published",
+        "url": "$link",
+        "author_name": "$feed:title",
+        "author_link": "$feed:link",
+        "color": "0xbade83",
+        "custom": "New on $feed:title: $title by $author ( $link )",
+    }
+    entry = {
+        "title": "Post",
+        "description": "Some text",
+        "published": "Mon, 05 Jan 2026 10:00:00 GMT",
+        "link": "http://example.com/post",
+        "author": "someone",
+        "feed:title": "Example",
+        "feed:link": "http://example.com",
+    }
+
+    def split_each_time(t):
+        v = []
+        for k in settings[t].split() if t in settings and settings[t] else []:
+            if k[0] == "$":
+                v.append(entry[k[1:]] if k[1:] in entry else None)
+            else:
+                v.append(k)
+        return " ".join(v) if not None in v else None
+
+    def compiled(t):
+        return template(settings.get(t)).render(entry)
+
+    rates = []
+    for name, format_key in (("split", split_each_time), ("compiled", compiled)):
+        start = time.perf_counter()
+        for i in range(renders // len(settings)):
+            for t in settings:
+                format_key(t)
+        rates.append(renders / (time.perf_counter() - start))
+        print("%s: %d fields/sec" % (name, rates[-1]))
+    print("speedup: %.2fx" % (rates[1] / rates[0]))
+    print(
+        "same output: %s"
+        % all(split_each_time(t) == compiled(t) for t in list(settings) + ["missing"])
+    )
+
+
+if __name__ == "__main__":
+    seen_entries_check()
+    stream_order_check()
+    template_benchmark()
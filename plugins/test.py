@@ -17,6 +17,9 @@ class Test(Plugin):
                 bot.util.Interface(
                     "mod-test", "checks if user is a mod", [], self.mod,
                 ),
+                bot.util.Interface(
+                    "threads", "lists the bot's threads and their CPU time", [], self.threads,
+                ),
             ],
         ).listen()
 
@@ -30,3 +33,27 @@ class Test(Plugin):
     @Plugin.authenticated
     def mod(self, message):
         self.bot.msg(message.target, "You are a mod", follows=message)
+
+    @Plugin.owner
+    def threads(self, message):
+        report = self.bot.util.thread_report()
+        lines = [
+            "%s threads running, %s jobs queued"
+            % (report["threads"], report["queued_jobs"])
+        ]
+        for w in report["workers"]:
+            lines.append(
+                "%s%s cpu: %s uptime: %ds%s"
+                % (
+                    w["name"],
+                    " " * (24 - len(w["name"])),
+                    "%.2fs" % w["cpu"] if w["cpu"] is not None else "?",
+                    w["uptime"],
+                    " (stopping)" if w["stopping"] else "",
+                )
+            )
+        self.bot.msg(
+            message.target,
+            self.bot.server.code_block("\n".join(lines)),
+            follows=message,
+        )
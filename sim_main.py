@@ -0,0 +1,19 @@
+import json
+from taiiwobot import taiiwobot, simulation
+
+config = {
+    # nothing touches a real database
+    "database": {"engine": "sqlite", "path": ":memory:"},
+    "plugin_blacklist": simulation.blacklist(["cookies"]),
+    # drop things often enough that collecting gets exercised
+    "plugin_config": {"sim": {"cookie_drop_rate": 40}},
+    # the same plan, drops and dice rolls every run, so a failure can be replayed
+    "rng_seed": "sim",
+    "users": 200,
+    "operations": 5000,
+    "concurrency": 20,
+}
+server = simulation.SimServer(config)
+# runs the simulation, then shuts down, flushing the cookie wallets
+taiiwobot.TaiiwoBot(server, config)
+print(json.dumps(server.report(), indent=2))
@@ -60,7 +60,7 @@ class Discord(Server):
                 # are we waiting for this message?
                 if callback_id == message.channel.id + message.author.id:
                     # run the message callback
-                    callback[1](message)
+                    util.run_async(callback[1](message))
                     del message_callbacks[callback_id]
                     # return here to not invoke other plugins with awaited messages
                     self.message_callbacks = message_callbacks
@@ -101,13 +101,15 @@ class Discord(Server):
                     return False
                 for reaction_emoji, function in reactions:
                     if reaction.emoji == reaction_emoji:
-                        function(
-                            {
-                                "emoji": reaction.emoji,
-                                "reactor": reactor.id,
-                                "message": reaction.message.id,
-                                "channel": reaction.message.channel.id,
-                            }
+                        util.run_async(
+                            function(
+                                {
+                                    "emoji": reaction.emoji,
+                                    "reactor": reactor.id,
+                                    "message": reaction.message.id,
+                                    "channel": reaction.message.channel.id,
+                                }
+                            )
                         )
                         # if it was a targeted callback, remove it
                         if user:
@@ -421,7 +423,7 @@ class Discord(Server):
                 if hasattr(data[0], "target"):
                     if not self.plugin_valid(plugin, data[0]):
                         continue
-                callback(*data)
+                util.run_async(callback(*data))
 
     def add_callback(self, callback, command, plugin_name):
         if command not in self.callbacks:
@@ -510,3 +512,9 @@ class Discord(Server):
                 buffer.append(await function(*args, **kwargs))
 
         self.client.loop.create_task(f())
+
+    def run_coroutine(self, coroutine):
+        # safe to call from other threads, the coroutine runs on the client loop
+        if asyncio.iscoroutine(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, self.client.loop)
+        return coroutine
@@ -0,0 +1,149 @@
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+ * Shared HTTP client
+
+ One requests session for every plugin that polls the web, so connections
+ are pooled and reused instead of opened per request. Every request has a
+ timeout, and retries connection errors and 429/5xx responses with
+ exponential backoff. Jobs wait in a queue for their host and only reach the
+ fetch threads while the host has a free slot, so a slow or struggling site
+ only ties up a few threads and never holds up the others.
+
+ Configure it with the "http" section of config.json, eg:
+
+    "http": {"pool_size": 32, "per_host": 4, "timeout": [5, 30], "retries": 3}
+"""
+
+
+class Fetcher:
+    """A pooled HTTP client with its own fetch threads
+
+    Args:
+        pool_size (int, optional): Pooled connections per host, and fetch threads
+        per_host (int, optional): Requests allowed in flight to one host
+        timeout (list, optional): Connect and read timeouts in seconds
+        retries (int, optional): Retries for failed requests
+        backoff (float, optional): Backoff factor between retries
+    """
+
+    def __init__(
+        self,
+        pool_size=32,
+        per_host=4,
+        timeout=(5, 30),
+        retries=3,
+        backoff=0.5,
+        user_agent="TaiiwoBot",
+    ):
+        self.per_host = per_host
+        self.timeout = tuple(timeout)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                # the body of an error is still returned after the last retry
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # {host: deque of jobs waiting for a slot} and {host: jobs running}
+        self.queues = {}
+        self.running = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="fetch"
+        )
+
+    def get(self, url, **kwargs):
+        """A blocking GET through the pooled session
+
+        Returns:
+            requests.Response: The response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def submit(self, url, func, *args, **kwargs):
+        """Runs a job that fetches from a URL on the fetch threads, once its
+        host has a free slot
+
+        Returns:
+            Future: The result of the job
+        """
+        future = Future()
+        host = urlsplit(url).netloc
+        with self.lock:
+            self.queues.setdefault(host, deque()).append((future, func, args, kwargs))
+        self.start_jobs(host)
+        return future
+
+    def start_jobs(self, host):
+        # hands a host's queued jobs to the threads while it has free slots
+        jobs = []
+        with self.lock:
+            queue = self.queues.get(host)
+            while queue and self.running.get(host, 0) < self.per_host:
+                self.running[host] = self.running.get(host, 0) + 1
+                jobs.append(queue.popleft())
+            if queue is not None and not queue:
+                del self.queues[host]
+        for job in jobs:
+            self.executor.submit(self.run, host, *job)
+
+    def run(self, host, future, func, args, kwargs):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running[host] -= 1
+                if not self.running[host]:
+                    del self.running[host]
+            self.start_jobs(host)
+
+    def close(self):
+        with self.lock:
+            queued = [job for queue in self.queues.values() for job in queue]
+            self.queues.clear()
+        for future, *job in queued:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+def benchmark(urls, repeat=3):
+    """Fetches a list of URLs concurrently and prints how long each round took"""
+    fetcher = Fetcher()
+    for i in range(repeat):
+        start = time.perf_counter()
+        futures = [fetcher.submit(url, fetcher.get, url) for url in urls]
+        statuses = [f.exception() or f.result().status_code for f in futures]
+        print(
+            "%s urls in %.2fs: %s"
+            % (len(urls), time.perf_counter() - start, statuses)
+        )
+    fetcher.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark(sys.argv[1:])
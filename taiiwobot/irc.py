@@ -55,9 +55,9 @@ class IRC(Server):
         if 'password' in self.config:
             self.msg("nickserv", "identify %s" % (self.config['password']))
         # listen forever
-        util.thread(self.listen)
+        util.thread(self.listen, name="irc-listen")
         # check the server is alive forever
-        util.thread(self.ECG)
+        util.thread(self.ECG, name="irc-ecg")
         for channel in self.config['autojoin']:
             self.join(channel)
 
@@ -118,6 +118,8 @@ class IRC(Server):
 
     def listen(self):
         for block in self.recv():
+            if util.stopping():
+                break
             # if the server stops responding, it sends us a blank string
             if block == "":
                 self.reconnect()
@@ -142,7 +144,8 @@ class IRC(Server):
             if time.time() - self.last_pulse > 300:
                 self.reconnect()
                 break
-            time.sleep(10)
+            if util.sleep(10):
+                break
 
     def format_message(self, raw_message):
         m = re.match(
@@ -1,4 +1,8 @@
 class Plugin:
+    # database indexes this plugin's queries rely on, in the form
+    # {"collection": [[("field", 1), ...], ...]}. Ensured before the plugin loads
+    indexes = {}
+
     @property
     def name(self):
         return self.__module__.split(".")[-1]
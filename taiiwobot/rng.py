@@ -0,0 +1,252 @@
+import os
+import hmac
+import time
+import random
+import struct
+import hashlib
+import itertools
+import threading
+
+"""
+ * Random numbers for games
+
+ Streams are independent generators, one per name, eg. "drops:<guild>", so a
+ busy guild can't shift the draws of another. Each one turns a single large
+ getrandbits() call into a batch of floats and hands them out in order.
+
+ Dice rolls are provably fair: each roll is an HMAC of the player's id and a
+ roll number, keyed by a secret seed whose hash is published beforehand. When
+ the seed is rotated it's revealed, and every roll made with it can be checked.
+
+ With the "rng_seed" config option everything becomes deterministic, for tests
+ and benchmarks. Without it seeds come from os.urandom.
+"""
+
+master_seed = None
+streams = {}
+fair_dice = {}
+lock = threading.Lock()
+
+
+def configure(seed=None):
+    # called by the bot with the "rng_seed" config option
+    global master_seed
+    master_seed = None if seed is None else str(seed)
+    streams.clear()
+    fair_dice.clear()
+
+
+def derive(name):
+    # a seed for a named stream, independent of every other name
+    if master_seed is None:
+        return os.urandom(32)
+    return hashlib.sha256(("%s:%s" % (master_seed, name)).encode()).digest()
+
+
+class Stream:
+    """A random stream that generates its draws in batches
+
+    Args:
+        seed (bytes): Seed for the generator
+        batch (int, optional): Draws generated at once. Defaults to 4096.
+    """
+
+    def __init__(self, seed, batch=4096):
+        self.generator = random.Random(seed)
+        self.batch = batch
+        self.unpack = struct.Struct("<%sQ" % batch).unpack
+        # the next float in [0, 1). It's a generator, which can't be resumed
+        # from two threads at once, and streams are used from workers too
+        self.next = itertools.chain.from_iterable(self.batches()).__next__
+        self.lock = threading.Lock()
+
+    def random(self):
+        with self.lock:
+            return self.next()
+
+    def batches(self):
+        while True:
+            # one call for the bits of the whole batch, 53 of every 64 become a float
+            bits = self.generator.getrandbits(64 * self.batch).to_bytes(
+                8 * self.batch, "little"
+            )
+            yield [(n >> 11) * 2 ** -53 for n in self.unpack(bits)]
+
+    def randrange(self, n):
+        return int(self.random() * n)
+
+    def randint(self, a, b):
+        return a + self.randrange(b - a + 1)
+
+    def choice(self, sequence):
+        return sequence[self.randrange(len(sequence))]
+
+    def shuffle(self, sequence):
+        for i in range(len(sequence) - 1, 0, -1):
+            j = self.randrange(i + 1)
+            sequence[i], sequence[j] = sequence[j], sequence[i]
+
+
+def stream(name="default"):
+    """Returns the stream for a name, eg. a shard or a guild"""
+    with lock:
+        if name not in streams:
+            streams[name] = Stream(derive(name))
+        return streams[name]
+
+
+def hmac_roll(seed, player, nonce, low, high):
+    # maps the first 52 bits of the HMAC onto low..high
+    digest = hmac.new(seed, ("%s:%s" % (player, nonce)).encode(), hashlib.sha256)
+    fraction = int(digest.hexdigest()[:13], 16) / 16 ** 13
+    return low + int(fraction * (high - low + 1))
+
+
+def commitment(seed):
+    return hashlib.sha256(seed).hexdigest()
+
+
+def verify(seed, committed, player, nonce, low, high, value):
+    """Checks a roll against a revealed seed and the commitment made before it
+
+    Args:
+        seed (str): The revealed seed, as hex
+        committed (str): The commitment published while the seed was secret
+    """
+    seed = bytes.fromhex(seed)
+    return commitment(seed) == committed and hmac_roll(
+        seed, player, nonce, low, high
+    ) == value
+
+
+class FairDice:
+    """Dice with a commit/reveal seed
+
+    Args:
+        name (str): Name of the dice, part of the derived seed
+        db (Repository, optional): Collection to keep the seed and roll count
+            in, so commitments survive a restart
+        reserve (int, optional): Roll numbers reserved per database write
+    """
+
+    def __init__(self, name, db=None, reserve=1000):
+        self.name = name
+        self.db = db
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.revealed = None
+        state = db.find_one({"_id": name}) if db else None
+        if state:
+            self.seed = bytes.fromhex(state["seed"])
+            # roll numbers up to the reservation may have been used already
+            self.nonce = self.reserved = state["reserved"]
+            self.revealed = state.get("revealed")
+        else:
+            self.seed = derive("dice:%s:0" % name)
+            self.nonce = self.reserved = 0
+        self.save()
+
+    def save(self):
+        if self.db:
+            self.db.replace_one(
+                {"_id": self.name},
+                {
+                    "_id": self.name,
+                    "seed": self.seed.hex(),
+                    "reserved": self.reserved,
+                    "revealed": self.revealed,
+                },
+                upsert=True,
+            )
+
+    @property
+    def commitment(self):
+        """The hash of the current seed, publish it before anyone bets"""
+        return commitment(self.seed)
+
+    def roll(self, player, low=1, high=100):
+        """Rolls a die for a player
+
+        Returns:
+            tuple: (value, roll number), the number is needed to verify it
+        """
+        with self.lock:
+            self.nonce += 1
+            nonce = self.nonce
+            if nonce > self.reserved:
+                self.reserved = nonce + self.reserve
+                self.save()
+            seed = self.seed
+        return hmac_roll(seed, player, nonce, low, high), nonce
+
+    def rotate(self):
+        """Starts a new seed and reveals the old one
+
+        Returns:
+            dict: The revealed seed, its commitment and the rolls it made
+        """
+        with self.lock:
+            self.revealed = {
+                "seed": self.seed.hex(),
+                "commitment": self.commitment,
+                "rolls": self.nonce,
+                "time": time.time(),
+            }
+            # the counter keeps going, so a roll number is never reused
+            self.seed = derive("dice:%s:%s" % (self.name, self.nonce))
+            self.save()
+            return self.revealed
+
+
+def dice(name="dice", db=None):
+    """Returns the fair dice for a name"""
+    with lock:
+        if name not in fair_dice:
+            fair_dice[name] = FairDice(name, db)
+        return fair_dice[name]
+
+
+def benchmark(draws=10 ** 6, rolls=10 ** 5):
+    """Compares batched draws with the random module and checks dice fairness"""
+    configure("benchmark")
+    start = time.perf_counter()
+    s = stream("benchmark")
+    for i in range(draws):
+        s.random()
+    batched = draws / (time.perf_counter() - start)
+    start = time.perf_counter()
+    r = random.Random(1)
+    for i in range(draws):
+        r.random()
+    plain = draws / (time.perf_counter() - start)
+    print("stream draws/sec: %d (random.random: %d)" % (batched, plain))
+
+    d = dice("benchmark")
+    counts = [0] * 100
+    start = time.perf_counter()
+    for i in range(rolls):
+        counts[d.roll(i % 1000)[0] - 1] += 1
+    print("dice rolls/sec: %d" % (rolls / (time.perf_counter() - start)))
+    expected = rolls / 100
+    chi2 = sum((c - expected) ** 2 / expected for c in counts)
+    # the 99.9th percentile of chi squared with 99 degrees of freedom
+    print("chi squared: %.1f, fair: %s" % (chi2, chi2 < 148.2))
+
+    value, nonce = d.roll("player")
+    committed = d.commitment
+    revealed = d.rotate()
+    print(
+        "verified: %s"
+        % verify(revealed["seed"], committed, "player", nonce, 1, 100, value)
+    )
+
+    # the same seed gives the same draws and rolls
+    def draws():
+        configure("benchmark")
+        return [stream("a").random() for i in range(3)], dice("a").roll("player")
+
+    print("deterministic: %s" % (draws() == draws()))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,152 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import concurrent.futures
+
+from . import util
+
+"""
+ * Persistent scheduler for delayed bot actions
+
+ Plugins register named actions, then schedule them with plain data:
+
+    bot.scheduler.register("countdown.finish", self.finish)
+    bot.scheduler.schedule_at(time.time() + 60, "countdown.finish", target=1234)
+
+ Every pending action is stored in the "scheduled_actions" collection, so
+ they're loaded again when the bot restarts. A single worker thread sleeps
+ until the next action is due, however many are pending. Actions may be
+ coroutines, in which case they're handed to the server's event loop.
+"""
+
+
+class Scheduler:
+    indexes = {"scheduled_actions": [[("due", 1)], [("action", 1)]]}
+
+    def __init__(self, run_coroutine=util.run_async, collection="scheduled_actions"):
+        self.run_coroutine = run_coroutine
+        self.collection = collection
+        self.actions = {}
+        # heap of (due, sequence, id), the documents are kept in self.pending_actions
+        self.heap = []
+        self.pending_actions = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.worker = None
+
+    @property
+    def db(self):
+        return util.get_db()[self.collection]
+
+    def register(self, name, function):
+        """Sets the function run for an action. Re-registering replaces it"""
+        self.actions[name] = function
+
+    def load(self):
+        # rehydrate the actions that were pending when the bot last stopped
+        util.get_db().ensure_indexes(self.indexes)
+        with self.condition:
+            for action in self.db.find({}):
+                self.push(action)
+
+    def push(self, action):
+        self.pending_actions[action["_id"]] = action
+        heapq.heappush(self.heap, (action["due"], next(self.sequence), action["_id"]))
+        self.condition.notify()
+
+    def schedule_at(self, timestamp, action, **data):
+        """Runs action(**data) at the given unix time
+
+        Returns:
+            The id of the scheduled action, for cancel()
+        """
+        document = {"due": timestamp, "action": action, "data": data}
+        self.db.insert_one(document)
+        with self.condition:
+            self.push(document)
+        return document["_id"]
+
+    def schedule_in(self, seconds, action, **data):
+        return self.schedule_at(time.time() + seconds, action, **data)
+
+    def cancel(self, action_id):
+        with self.condition:
+            # the heap entry is skipped when it comes up
+            self.pending_actions.pop(action_id, None)
+        self.db.delete_one({"_id": action_id})
+
+    def pending(self, action=None):
+        with self.condition:
+            return [
+                a
+                for a in self.pending_actions.values()
+                if action is None or a["action"] == action
+            ]
+
+    def start(self):
+        if not self.worker:
+            self.worker = util.thread(self.run, name="scheduler")
+
+    def stop(self):
+        if self.worker:
+            self.worker.stop()
+            with self.condition:
+                self.condition.notify()
+            self.worker = None
+
+    def next_due(self):
+        # waits for the next action to come due, or returns None when stopping
+        with self.condition:
+            while not util.stopping():
+                # drop cancelled entries from the top of the heap
+                while self.heap and self.heap[0][2] not in self.pending_actions:
+                    heapq.heappop(self.heap)
+                if self.heap and self.heap[0][0] <= time.time():
+                    return self.pending_actions.pop(heapq.heappop(self.heap)[2])
+                self.condition.wait(
+                    min(self.heap[0][0] - time.time(), 60) if self.heap else 60
+                )
+        return None
+
+    def run(self):
+        while True:
+            action = self.next_due()
+            if action is None:
+                break
+            function = self.actions.get(action["action"])
+            if not function:
+                # leave it in the database, it'll be retried after a restart
+                util.debug(
+                    "[W] No handler for scheduled action %s" % action["action"]
+                )
+                continue
+            try:
+                result = self.run_coroutine(function(**action["data"]))
+            except Exception as e:
+                self.finished(action, e)
+                continue
+            if isinstance(result, (concurrent.futures.Future, asyncio.Future)):
+                # a coroutine handed to an event loop, it hasn't run yet
+                result.add_done_callback(
+                    lambda future, action=action: self.done(action, future)
+                )
+            else:
+                self.finished(action)
+
+    def done(self, action, future):
+        if future.cancelled():
+            self.finished(action, "cancelled")
+        else:
+            self.finished(action, future.exception())
+
+    def finished(self, action, error=None):
+        # a failed action stays in the database, so it's retried after a restart
+        if error:
+            util.debug(
+                "[E] Scheduled action %s failed: %r" % (action["action"], error)
+            )
+            return
+        # done callbacks may run on an event loop, so delete it on the job pool
+        util.submit(self.db.delete_one, {"_id": action["_id"]})
@@ -78,6 +78,10 @@ class Server:
             except util.RuntimeError as e:
                 print(e.text)
 
+    def run_coroutine(self, coroutine):
+        # runs a coroutine from outside the server's callbacks, e.g. the scheduler
+        return util.run_async(coroutine)
+
     def add_callback(self, callback, command):
         if command not in self.callbacks:
             self.callbacks[command] = []
@@ -0,0 +1,296 @@
+import os
+import time
+import random
+import asyncio
+import contextvars
+
+from . import util
+from .server import Server
+from .test_server import TestServer
+
+"""
+ * Headless load simulation for the Cookies plugin
+
+ SimServer plays a chat full of synthetic users against the real plugin,
+ running on an in-memory SQLite database. Every operation is a message or a
+ reaction fed through the same callbacks a real server would use, and it is
+ timed until every task it started has finished. Run it with sim_main.py.
+"""
+
+# the operation the current task belongs to, inherited by the tasks it starts
+current_op = contextvars.ContextVar("current_op", default=None)
+
+# relative rates of each kind of operation
+default_rates = {
+    "chat": 60,
+    "balance": 10,
+    "drop": 5,
+    "give": 8,
+    "dice": 8,
+    "offer": 4,
+    "shop": 5,
+}
+
+
+class Operation:
+    def __init__(self, kind, user, random):
+        self.kind = kind
+        self.user = user
+        # its own generator, so its choices don't depend on how tasks interleave
+        self.random = random
+        self.tasks = set()
+        # messages sent while handling this operation, waiting for a reaction
+        self.messages = []
+        # the price of what was picked in the shop
+        self.price = 0
+
+
+class SimServer(TestServer):
+    def __init__(self, config):
+        defaults = {
+            "user": 10 ** 6,
+            "users": 200,
+            "operations": 5000,
+            "concurrency": 20,
+            "rates": default_rates,
+            "starting_cookies": 100,
+        }
+        defaults.update(config)
+        super().__init__(defaults)
+        self.type = "sim"
+        self.reaction_callbacks = {}
+        self.message_ids = 0
+        # cookies spawned from nothing and collected, and spent in the shop
+        self.minted = 0
+        self.burned = 0
+        self.latencies = {}
+        self.errors = 0
+        self.elapsed = 0
+        # the plan and every choice come from the seed, so a run can be replayed
+        self.seed = self.config.get("rng_seed")
+        self.random = random.Random(self.seed)
+
+    def start(self):
+        # seed the economy before the plugin loads
+        util.get_db()["cookies"].insert_many(
+            [
+                {
+                    "user": user,
+                    "cookies": self.config["starting_cookies"],
+                    "items": {"Milk": 5},
+                }
+                for user in range(1, self.config["users"] + 1)
+            ]
+            # a rich house, so dice payouts never run it dry
+            + [{"user": self.me(), "cookies": 10 ** 9}]
+        )
+        super().start()
+
+    def listen(self):
+        asyncio.run(self.simulate())
+
+    def trigger(self, event, *data):
+        if event in self.callbacks:
+            util.callback(self.callbacks[event], *data)
+
+    def mention(self, user):
+        return "<@%s>" % user
+
+    def get_mentions(self, message):
+        return [
+            int(word.strip("<@!>"))
+            for word in message.content.split(" ")
+            if word.startswith("<@")
+        ]
+
+    def msg(
+        self,
+        target,
+        message,
+        embed=None,
+        reactions=tuple(),
+        user=None,
+        callback=None,
+        follows=None,
+        delete_after=False,
+        **kwargs
+    ):
+        self.message_ids += 1
+        op = current_op.get()
+        if op and "successfully purchased" in message:
+            self.burned += op.price
+        reactions = list(reactions)
+        if reactions:
+            self.reaction_callbacks[self.message_ids] = (user, reactions)
+            if op:
+                op.messages.append((self.message_ids, target, message, user))
+        return self.message_ids
+
+    def menu(self, target, user, question, answers=None, ync=None, cancel=False, **kwargs):
+        Server.menu(self, target, user, question, answers, ync, cancel)
+
+    def prompt(self, target, user, prompt, handler, cancel=False, timeout=60.0):
+        Server.prompt(self, str(target), str(user), prompt, handler, cancel, timeout)
+
+    def task_factory(self, loop, coro, context=None):
+        # remember which operation started each task, so it can be waited for
+        if context is None:
+            task = asyncio.Task(coro, loop=loop)
+        else:
+            task = asyncio.Task(coro, loop=loop, context=context)
+        op = current_op.get()
+        if op:
+            op.tasks.add(task)
+        return task
+
+    async def settle(self, op):
+        while op.tasks:
+            tasks, op.tasks = op.tasks, set()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    self.errors += 1
+                    util.debug("[E] %s failed: %r" % (op.kind, result))
+
+    def react(self, message_id, emoji, reactor, channel):
+        # the same rules as a discord reaction
+        if message_id not in self.reaction_callbacks:
+            return
+        user, reactions = self.reaction_callbacks[message_id]
+        if user and user != reactor:
+            return
+        for reaction_emoji, function in reactions:
+            if reaction_emoji == emoji:
+                if user:
+                    del self.reaction_callbacks[message_id]
+                util.run_async(
+                    function(
+                        {
+                            "emoji": emoji,
+                            "reactor": reactor,
+                            "message": message_id,
+                            "channel": channel,
+                        }
+                    )
+                )
+                return True
+
+    def send(self, user, content, channel="sim"):
+        self.trigger(
+            "message",
+            util.Message(
+                nick=str(user),
+                username=str(user),
+                author_id=user,
+                type="message",
+                target=channel,
+                content=content,
+                server="sim",
+                raw_message=content,
+                timestamp=time.time(),
+            ),
+        )
+
+    def command(self, op):
+        kind, user, rng = op.kind, op.user, op.random
+        users = self.config["users"]
+        # anyone but the user themself
+        other = (user + rng.randint(0, users - 2)) % users + 1
+        if kind == "chat":
+            return "just chatting %s" % rng.random()
+        if kind == "balance":
+            return "$cookie balance"
+        if kind == "drop":
+            return "$cookie drop"
+        if kind == "give":
+            return "$cookie give <@%s> %s" % (other, rng.randint(1, 10))
+        if kind == "dice":
+            return "$cookie dice %s" % rng.randint(1, 10)
+        if kind == "offer":
+            return "$cookie offer <@%s> -i Milk -a %s -c" % (other, rng.randint(1, 10))
+        if kind == "shop":
+            return "$cookie shop"
+
+    def answer(self, op, message_id, target, message, user):
+        # how a synthetic user would react to something the bot sent
+        reactions = [r[0] for r in self.reaction_callbacks.get(message_id, (0, []))[1]]
+        if not reactions:
+            return
+        if "👍" in reactions:
+            emoji = "👍"
+        else:
+            emoji = op.random.choice(reactions)
+        if message.startswith("Welcome to the cookie shop"):
+            # lines look like "[🥛] Milk - 5 Cookies"
+            for line in message.split("\n")[1:]:
+                if line.startswith("[%s]" % emoji):
+                    op.price = int(line.split(" - ")[-1].split(" ")[0])
+        reactor = user or op.random.randint(1, self.config["users"])
+        if self.react(message_id, emoji, reactor, target) and message == "A cookie appeared":
+            self.minted += 1
+
+    async def run_op(self, kind, user, seed):
+        op = Operation(kind, user, random.Random(seed))
+        token = current_op.set(op)
+        start = time.perf_counter()
+        try:
+            self.send(op.user, self.command(op))
+            await self.settle(op)
+            # keep answering menus and drops until nothing is left
+            while op.messages:
+                messages, op.messages = op.messages, []
+                for message in messages:
+                    self.answer(op, *message)
+                await self.settle(op)
+        finally:
+            current_op.reset(token)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def simulate(self):
+        asyncio.get_running_loop().set_task_factory(self.task_factory)
+        kinds, weights = zip(*self.config["rates"].items())
+        plan = [
+            (kind, self.random.randint(1, self.config["users"]), self.random.random())
+            for kind in self.random.choices(kinds, weights, k=self.config["operations"])
+        ]
+        start = time.perf_counter()
+        for i in range(0, len(plan), self.config["concurrency"]):
+            await asyncio.gather(
+                *[self.run_op(*op) for op in plan[i : i + self.config["concurrency"]]]
+            )
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        """Returns throughput, latency and ledger consistency. Call after the bot stops"""
+        everything = sorted(l for ls in self.latencies.values() for l in ls)
+
+        def p99(latencies):
+            latencies = sorted(latencies)
+            return latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+
+        documents = list(util.get_db()["cookies"].find({}))
+        expected = (
+            self.config["users"] * self.config["starting_cookies"]
+            + 10 ** 9
+            + self.minted
+            - self.burned
+        )
+        total = sum(d.get("cookies", 0) for d in documents)
+        return {
+            "operations": len(everything),
+            "ops_per_sec": len(everything) / self.elapsed if self.elapsed else 0,
+            "p99_ms": p99(everything),
+            "by_kind": {
+                kind: {"count": len(l), "p99_ms": p99(l)}
+                for kind, l in sorted(self.latencies.items())
+            },
+            "errors": self.errors,
+            "minted": self.minted,
+            "burned": self.burned,
+            "conserved": total == expected,
+            "negative_balances": sum(1 for d in documents if d.get("cookies", 0) < 0),
+        }
+
+
+def blacklist(keep=("cookies",)):
+    # every plugin except the ones being simulated
+    return [f[:-3] for f in os.listdir("plugins") if f.endswith(".py") and f[:-3] not in keep]
@@ -0,0 +1,1169 @@
+import json
+import time
+import uuid
+import base64
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+"""
+ * Storage layer for plugin data
+
+ Plugins get a Database from util.get_db(). Indexing it with a collection
+ name returns a Repository, which speaks the subset of the pymongo collection
+ API that the plugins use. The engine behind it is picked by the "database"
+ section of the config:
+
+    "database": {
+        "engine": "mongo",            # or "sqlite"
+        "name": "taiiwobot",
+        "uri": "mongodb://localhost:27017",
+        "path": "taiiwobot.db",       # sqlite only
+        "pool": {"maxPoolSize": 50},  # mongo only, passed to MongoClient
+        "async_workers": 8,           # max concurrent queries from the event loop
+        "query_audit": false          # log queries that scan a whole collection
+    }
+
+ Plugins declare the indexes their queries need with a class attribute, and
+ TaiiwoBot ensures them before the plugin is loaded:
+
+    indexes = {"cookies": [[("user", ASCENDING)], [("cookies", DESCENDING)]]}
+
+ util.get_async_db() wraps the same Database for use from coroutines. Every
+ call is run on a bounded thread pool so a slow query never blocks the event
+ loop, and its latency is recorded against the collection it touched.
+"""
+
+# pymongo style result objects, so plugins can treat both engines the same
+InsertOneResult = namedtuple("InsertOneResult", "inserted_id")
+InsertManyResult = namedtuple("InsertManyResult", "inserted_ids")
+UpdateResult = namedtuple("UpdateResult", "matched_count modified_count upserted_id")
+DeleteResult = namedtuple("DeleteResult", "deleted_count")
+BulkWriteResult = namedtuple(
+    "BulkWriteResult", "inserted_count matched_count modified_count deleted_count"
+)
+
+# bulk write operations, accepted by Repository.bulk_write on every engine
+InsertOne = namedtuple("InsertOne", "document")
+UpdateOne = namedtuple("UpdateOne", "filter update upsert")
+UpdateOne.__new__.__defaults__ = (False,)
+UpdateMany = namedtuple("UpdateMany", "filter update upsert")
+UpdateMany.__new__.__defaults__ = (False,)
+DeleteOne = namedtuple("DeleteOne", "filter")
+DeleteMany = namedtuple("DeleteMany", "filter")
+
+ASCENDING = 1
+DESCENDING = -1
+
+# connection pool defaults for the mongo engine. Anything in the "pool"
+# section of the database config overrides these
+default_pool = {
+    "maxPoolSize": 50,
+    "minPoolSize": 0,
+    "maxIdleTimeMS": 60 * 1000,
+    "waitQueueTimeoutMS": 10 * 1000,
+    "connectTimeoutMS": 5 * 1000,
+    "socketTimeoutMS": 30 * 1000,
+    "serverSelectionTimeoutMS": 5 * 1000,
+    "retryWrites": True,
+}
+
+
+class Error(Exception):
+    pass
+
+
+def connect(settings=None):
+    """Creates a Database for the engine named in settings
+
+    Args:
+        settings (dict, optional): The "database" section of the config.
+
+    Returns:
+        Database: A MongoDatabase or SQLiteDatabase
+    """
+    settings = dict(settings or {})
+    engine = settings.get("engine", "mongo")
+    if engine == "mongo":
+        return MongoDatabase(settings)
+    elif engine == "sqlite":
+        return SQLiteDatabase(settings)
+    raise Error("Unknown database engine: %s" % engine)
+
+
+class Database:
+    def __init__(self, settings):
+        self.settings = settings
+        self.name = settings.get("name", "taiiwobot")
+        self.repositories = {}
+
+    def __getitem__(self, name):
+        if name not in self.repositories:
+            self.repositories[name] = self.repository(name)
+        return self.repositories[name]
+
+    def repository(self, name):
+        raise NotImplementedError
+
+    def ensure_indexes(self, indexes):
+        """Creates any missing indexes
+
+        Args:
+            indexes (dict): collection name -> list of index key lists
+        """
+        for name, specs in (indexes or {}).items():
+            for keys in specs:
+                self[name].create_index(list(keys))
+
+    def close(self):
+        pass
+
+
+class Repository:
+    """A named collection of documents
+
+    Engines implement the primitive operations, everything else (legacy
+    aliases, batching) is built on top of them here.
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        # query shapes that have already been audited
+        self.audited = set()
+
+    def audit(self, filter):
+        """Logs the query if it has to scan the whole collection
+
+        Only runs with "query_audit" enabled, and once per query shape, so it's
+        cheap enough to leave on while testing a plugin.
+        """
+        if not self.database.settings.get("query_audit"):
+            return
+        shape = query_shape(filter)
+        if shape in self.audited:
+            return
+        self.audited.add(shape)
+        if self.is_collection_scan(filter):
+            print("[W] Collection scan on %s: %s" % (self.name, shape))
+
+    def is_collection_scan(self, filter):
+        raise NotImplementedError
+
+    # pymongo 3 names still used around the plugins
+    def update(self, filter, update, upsert=False):
+        return self.update_one(filter, update, upsert=upsert)
+
+    def remove(self, filter=None):
+        return self.delete_many(filter or {})
+
+    def batch(self, size=500):
+        """Collects write operations and sends them in bulk
+
+        Use as a context manager:
+            with repository.batch() as batch:
+                batch.add(UpdateOne({"user": 1}, {"$inc": {"cookies": 1}}))
+        """
+        return Batch(self, size)
+
+
+class Batch:
+    def __init__(self, repository, size):
+        self.repository = repository
+        self.size = size
+        self.operations = []
+
+    def add(self, operation):
+        self.operations.append(operation)
+        if len(self.operations) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.operations:
+            operations, self.operations = self.operations, []
+            return self.repository.bulk_write(operations)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # don't write half a batch if the block blew up
+        if exc_type is None:
+            self.flush()
+
+
+# Mongo engine
+
+
+class MongoDatabase(Database):
+    def __init__(self, settings):
+        super().__init__(settings)
+        import pymongo
+
+        self.pymongo = pymongo
+        pool = default_pool.copy()
+        pool.update(settings.get("pool", {}))
+        self.client = pymongo.MongoClient(settings.get("uri"), **pool)
+        self.db = self.client[self.name]
+
+    def repository(self, name):
+        return MongoRepository(self, name)
+
+    def close(self):
+        self.client.close()
+
+
+class MongoRepository(Repository):
+    def __init__(self, database, name):
+        super().__init__(database, name)
+        self.collection = database.db[name]
+
+    def is_collection_scan(self, filter):
+        plan = self.collection.find(filter or {}).explain()
+        return "COLLSCAN" in str(plan.get("queryPlanner", plan))
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        self.audit(filter)
+        return self.collection.find_one(filter or {}, projection, sort=sort)
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        self.audit(filter)
+        return self.collection.find(
+            filter or {}, projection, sort=sort, limit=limit, skip=skip
+        )
+
+    def count_documents(self, filter=None):
+        self.audit(filter)
+        return self.collection.count_documents(filter or {})
+
+    def insert_one(self, document):
+        return self.collection.insert_one(document)
+
+    def insert_many(self, documents):
+        return self.collection.insert_many(documents)
+
+    def update_one(self, filter, update, upsert=False):
+        self.audit(filter)
+        return self.collection.update_one(filter, update, upsert=upsert)
+
+    def update_many(self, filter, update, upsert=False):
+        self.audit(filter)
+        return self.collection.update_many(filter, update, upsert=upsert)
+
+    def replace_one(self, filter, document, upsert=False):
+        self.audit(filter)
+        return self.collection.replace_one(filter, document, upsert=upsert)
+
+    def delete_one(self, filter):
+        self.audit(filter)
+        return self.collection.delete_one(filter)
+
+    def delete_many(self, filter):
+        self.audit(filter)
+        return self.collection.delete_many(filter)
+
+    def bulk_write(self, operations, ordered=True):
+        if not operations:
+            return BulkWriteResult(0, 0, 0, 0)
+        pymongo = self.database.pymongo
+        converted = []
+        for op in operations:
+            if isinstance(op, InsertOne):
+                converted.append(pymongo.InsertOne(op.document))
+            elif isinstance(op, UpdateOne):
+                converted.append(pymongo.UpdateOne(op.filter, op.update, op.upsert))
+            elif isinstance(op, UpdateMany):
+                converted.append(pymongo.UpdateMany(op.filter, op.update, op.upsert))
+            elif isinstance(op, DeleteOne):
+                converted.append(pymongo.DeleteOne(op.filter))
+            elif isinstance(op, DeleteMany):
+                converted.append(pymongo.DeleteMany(op.filter))
+            else:
+                # already a pymongo operation
+                converted.append(op)
+        r = self.collection.bulk_write(converted, ordered=ordered)
+        return BulkWriteResult(
+            r.inserted_count, r.matched_count, r.modified_count, r.deleted_count
+        )
+
+    def create_index(self, keys, **kwargs):
+        return self.collection.create_index(keys, **kwargs)
+
+
+# SQLite engine
+#
+# Each collection is a table of (_id, doc) rows where doc is the JSON encoded
+# document. Queries are evaluated in python against the decoded documents,
+# using the same operator semantics as mongo for the operators we support.
+
+
+def encode(document):
+    def default(o):
+        if isinstance(o, datetime):
+            return {"$date": o.isoformat()}
+        if isinstance(o, bytes):
+            return {"$binary": base64.b64encode(o).decode()}
+        raise TypeError("Can't store %s in the database" % type(o).__name__)
+
+    return json.dumps(document, default=default, separators=(",", ":"))
+
+
+def decode(text):
+    def object_hook(o):
+        if len(o) == 1:
+            if "$date" in o:
+                return datetime.fromisoformat(o["$date"])
+            if "$binary" in o:
+                return base64.b64decode(o["$binary"])
+        return o
+
+    return json.loads(text, object_hook=object_hook)
+
+
+def resolve(document, path):
+    """Returns every value found at a dotted path, descending into arrays"""
+
+    def walk(value, parts):
+        if not parts:
+            return [value]
+        if isinstance(value, dict):
+            if parts[0] in value:
+                return walk(value[parts[0]], parts[1:])
+            return []
+        if isinstance(value, list):
+            if parts[0].isdigit():
+                i = int(parts[0])
+                return walk(value[i], parts[1:]) if i < len(value) else []
+            found = []
+            for item in value:
+                found.extend(walk(item, parts))
+            return found
+        return []
+
+    return walk(document, path.split("."))
+
+
+def query_shape(filter):
+    # the fields and operators of a filter, with the values masked out
+    def mask(value):
+        if isinstance(value, dict):
+            return {k: mask(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [mask(v) for v in value]
+        return "?"
+
+    return json.dumps(mask(filter or {}), sort_keys=True)
+
+
+def candidates(values):
+    # array values match a condition if any of their elements do
+    out = []
+    for v in values:
+        out.append(v)
+        if isinstance(v, list):
+            out.extend(v)
+    return out
+
+
+def compare(a, op, b):
+    try:
+        if op == "$gt":
+            return a > b
+        if op == "$gte":
+            return a >= b
+        if op == "$lt":
+            return a < b
+        if op == "$lte":
+            return a <= b
+    except TypeError:
+        # mongo never matches across types
+        return False
+    raise Error("Unsupported comparison: %s" % op)
+
+
+def is_operator_dict(value):
+    return isinstance(value, dict) and value and all(k[0] == "$" for k in value)
+
+
+def match_condition(values, condition):
+    if is_operator_dict(condition):
+        for op, arg in condition.items():
+            if op == "$exists":
+                if bool(values) != bool(arg):
+                    return False
+            elif op == "$eq":
+                if not match_condition(values, arg):
+                    return False
+            elif op == "$ne":
+                if match_condition(values, arg):
+                    return False
+            elif op == "$in":
+                if not any(match_condition(values, a) for a in arg):
+                    return False
+            elif op == "$nin":
+                if any(match_condition(values, a) for a in arg):
+                    return False
+            elif op == "$elemMatch":
+                if not any(
+                    match(v, arg) if isinstance(v, dict) else match_condition([v], arg)
+                    for value in values
+                    if isinstance(value, list)
+                    for v in value
+                ):
+                    return False
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                if not any(compare(v, op, arg) for v in candidates(values)):
+                    return False
+            else:
+                raise Error("Unsupported query operator: %s" % op)
+        return True
+    if condition is None and not values:
+        # {"field": None} matches documents without the field
+        return True
+    return any(v == condition for v in candidates(values))
+
+
+def match(document, filter):
+    """Returns True if the document satisfies the mongo style filter"""
+    for key, condition in (filter or {}).items():
+        if key == "$and":
+            if not all(match(document, f) for f in condition):
+                return False
+        elif key == "$or":
+            if not any(match(document, f) for f in condition):
+                return False
+        elif key == "$nor":
+            if any(match(document, f) for f in condition):
+                return False
+        elif not match_condition(resolve(document, key), condition):
+            return False
+    return True
+
+
+def project(document, projection):
+    if not projection:
+        return document
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        out = {}
+        for key in include:
+            values = resolve(document, key)
+            if not values:
+                continue
+            # rebuild dotted keys as nested documents
+            parts = key.split(".")
+            target = out
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = values[0]
+    else:
+        out = {k: v for k, v in document.items() if k not in projection}
+    if projection.get("_id", True) and "_id" in document:
+        out["_id"] = document["_id"]
+    else:
+        out.pop("_id", None)
+    return out
+
+
+def sort_key(fields):
+    def key(document):
+        out = []
+        for field, direction in fields:
+            values = resolve(document, field)
+            # arrays sort by their lowest value ascending and highest descending
+            try:
+                value = (min if direction > 0 else max)(values) if values else None
+            except TypeError:
+                value = values[0]
+            # missing values sort before everything else, like mongo
+            out.append((value is not None, value))
+        return out
+
+    return key
+
+
+def sort_documents(documents, sort):
+    # sort one field at a time from last to first, relying on sort stability
+    for field, direction in reversed(list(sort)):
+        documents.sort(key=sort_key([(field, direction)]), reverse=direction < 0)
+    return documents
+
+
+def split_path(document, path, create=False):
+    """Walks to the parent of the last element of a dotted path"""
+    parts = path.split(".")
+    target = document
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        elif part in target and target[part] is not None:
+            target = target[part]
+        elif create:
+            target[part] = {}
+            target = target[part]
+        else:
+            return None, parts[-1]
+    return target, parts[-1]
+
+
+def positional(path, document, filter):
+    # replaces "array.$" with the index of the first element matched by the
+    # filter, eg. {"destinations.target": 1} and "destinations.$.keys"
+    if ".$" not in path:
+        return path
+    array_path, rest = path.split(".$", 1)
+    array = resolve(document, array_path)
+    array = array[0] if array and isinstance(array[0], list) else []
+    prefix = array_path + "."
+    conditions = {k[len(prefix) :]: v for k, v in filter.items() if k.startswith(prefix)}
+    for i, element in enumerate(array):
+        if isinstance(element, dict):
+            found = match(element, conditions)
+        else:
+            # arrays of plain values are matched by the array field itself
+            found = array_path in filter and match_condition([element], filter[array_path])
+        if found:
+            return "%s.%s%s" % (array_path, i, rest)
+    raise Error("The positional operator did not find the match needed from the query")
+
+
+def apply_update(document, update, filter=None):
+    """Applies a mongo style update to a document in place
+
+    Returns:
+        bool: True if the document was modified
+    """
+    before = encode(document)
+    if not any(k[0] == "$" for k in update):
+        # a replacement document
+        _id = document.get("_id")
+        document.clear()
+        document.update(update)
+        if _id is not None:
+            document["_id"] = _id
+        return encode(document) != before
+    for op, fields in update.items():
+        for path, value in fields.items():
+            path = positional(path, document, filter or {})
+            parent, key = split_path(document, path, create=op != "$unset")
+            if isinstance(parent, list):
+                key = int(key)
+            if op == "$set":
+                parent[key] = value
+            elif op == "$unset":
+                if parent is not None:
+                    if isinstance(parent, list):
+                        parent[key] = None
+                    else:
+                        parent.pop(key, None)
+            elif op == "$inc":
+                parent[key] = parent.get(key, 0) + value
+            elif op == "$min":
+                if key not in parent or value < parent[key]:
+                    parent[key] = value
+            elif op == "$max":
+                if key not in parent or value > parent[key]:
+                    parent[key] = value
+            elif op in ("$push", "$addToSet"):
+                array = parent.setdefault(key, [])
+                values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for v in values:
+                    if op == "$push" or v not in array:
+                        array.append(v)
+            elif op == "$pull":
+                if parent is None or key not in parent:
+                    continue
+                if isinstance(value, dict) and not is_operator_dict(value):
+                    parent[key] = [
+                        v for v in parent[key] if not (isinstance(v, dict) and match(v, value))
+                    ]
+                else:
+                    parent[key] = [
+                        v for v in parent[key] if not match_condition([v], value)
+                    ]
+            elif op == "$pop":
+                if parent is not None and parent.get(key):
+                    parent[key].pop(0 if value < 0 else -1)
+            else:
+                raise Error("Unsupported update operator: %s" % op)
+    return encode(document) != before
+
+
+def upsert_document(filter):
+    # seed a new document with the equality parts of the filter
+    document = {}
+    for key, value in filter.items():
+        if key[0] == "$" or is_operator_dict(value):
+            continue
+        parent, k = split_path(document, key, create=True)
+        parent[k] = value
+    return document
+
+
+# comparisons that can be answered from an index table
+index_operators = {"$eq": "=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def index_value(value):
+    # the value stored in an index table, or None if it can't be indexed
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return None
+
+
+def index_clause(condition):
+    """Turns a filter condition into a WHERE clause on an index table
+
+    The clause only has to narrow down the candidates, every document it
+    returns is still checked against the full filter in python.
+    """
+    if is_operator_dict(condition):
+        clauses, args = [], []
+        for op, arg in condition.items():
+            if op in index_operators and index_value(arg) is not None:
+                clauses.append("value %s ?" % index_operators[op])
+                args.append(index_value(arg))
+            elif op == "$in" and all(index_value(a) is not None for a in arg):
+                clauses.append("value IN (%s)" % ", ".join("?" * len(arg)))
+                args.extend(index_value(a) for a in arg)
+        return (" AND ".join(clauses), args) if clauses else None
+    if index_value(condition) is not None:
+        return "value = ?", [index_value(condition)]
+    return None
+
+
+def quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class SQLiteDatabase(Database):
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.path = settings.get("path", self.name + ".db")
+        # the plugins call the database from the event loop and from their own
+        # threads, so share one connection behind a lock
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=settings.get("timeout", 30),
+        )
+        if self.path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    def repository(self, name):
+        return SQLiteRepository(self, name)
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        # nested transactions join the outer one
+        with self.lock:
+            if self.connection.in_transaction:
+                yield
+                return
+            self.connection.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SQLiteRepository(Repository):
+    def __init__(self, database, name):
+        super().__init__(database, name)
+        self.table = quote(name)
+        database.execute(
+            "CREATE TABLE IF NOT EXISTS %s (_id TEXT PRIMARY KEY, doc TEXT NOT NULL)"
+            % self.table
+        )
+        # indexed field -> index table. An index table holds one (value, _id)
+        # row for every value found at the field, so array fields work too
+        self.indexes = {}
+        prefix = name + "$"
+        for (table,) in database.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ):
+            if table.startswith(prefix) and "$" not in table[len(prefix) :]:
+                self.indexes[table[len(prefix) :]] = quote(table)
+
+    def plan(self, filter):
+        """Picks the query for the rows that might match the filter
+
+        Returns:
+            tuple: sql, args, and whether an index was used
+        """
+        if "_id" in filter and index_value(filter["_id"]) is not None:
+            return (
+                "SELECT _id, doc FROM %s WHERE _id = ?" % self.table,
+                (encode(filter["_id"]),),
+                True,
+            )
+        ranged = None
+        for key, condition in filter.items():
+            if key not in self.indexes:
+                continue
+            clause = index_clause(condition)
+            if not clause:
+                continue
+            if "value = ?" in clause[0] or "value IN" in clause[0]:
+                # equality is the most selective, use it straight away
+                ranged = (key, clause)
+                break
+            ranged = ranged or (key, clause)
+        if ranged:
+            key, (where, args) = ranged
+            return (
+                "SELECT _id, doc FROM %s WHERE _id IN (SELECT _id FROM %s WHERE %s)"
+                % (self.table, self.indexes[key], where),
+                args,
+                True,
+            )
+        return "SELECT _id, doc FROM %s" % self.table, (), False
+
+    def is_collection_scan(self, filter):
+        return not self.plan(filter or {})[2]
+
+    def rows(self, filter):
+        # loads the documents that match the filter
+        filter = filter or {}
+        self.audit(filter)
+        sql, args, indexed = self.plan(filter)
+        for key, doc in self.database.execute(sql, args):
+            document = decode(doc)
+            document["_id"] = decode(key)
+            if match(document, filter):
+                yield document
+
+    def write_index(self, field, document, key):
+        self.database.execute(
+            "DELETE FROM %s WHERE _id = ?" % self.indexes[field], (key,)
+        )
+        values = [index_value(v) for v in candidates(resolve(document, field))]
+        self.database.connection.executemany(
+            "INSERT INTO %s (value, _id) VALUES (?, ?)" % self.indexes[field],
+            [(v, key) for v in values if v is not None],
+        )
+
+    def write(self, document):
+        document = dict(document)
+        key = encode(document.pop("_id"))
+        with self.database.transaction():
+            self.database.execute(
+                "INSERT OR REPLACE INTO %s (_id, doc) VALUES (?, ?)" % self.table,
+                (key, encode(document)),
+            )
+            for field in self.indexes:
+                self.write_index(field, document, key)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        if sort:
+            documents = sort_documents(list(self.rows(filter)), sort)
+            return project(documents[0], projection) if documents else None
+        for document in self.rows(filter):
+            return project(document, projection)
+        return None
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        cursor = Cursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def count_documents(self, filter=None):
+        return sum(1 for d in self.rows(filter))
+
+    def insert_one(self, document):
+        if "_id" not in document:
+            document["_id"] = uuid.uuid4().hex
+        with self.database.lock:
+            if self.database.execute(
+                "SELECT 1 FROM %s WHERE _id = ?" % self.table,
+                (encode(document["_id"]),),
+            ):
+                raise Error("Duplicate _id: %s" % document["_id"])
+            self.write(document)
+        return InsertOneResult(document["_id"])
+
+    def insert_many(self, documents):
+        with self.database.transaction():
+            return InsertManyResult(
+                [self.insert_one(d).inserted_id for d in documents]
+            )
+
+    def update_documents(self, filter, update, upsert, many):
+        matched = modified = 0
+        upserted_id = None
+        with self.database.transaction():
+            for document in self.rows(filter):
+                matched += 1
+                if apply_update(document, update, filter):
+                    modified += 1
+                    self.write(document)
+                if not many:
+                    break
+            if not matched and upsert:
+                document = upsert_document(filter)
+                apply_update(document, update, filter)
+                upserted_id = self.insert_one(document).inserted_id
+        return UpdateResult(matched, modified, upserted_id)
+
+    def update_one(self, filter, update, upsert=False):
+        return self.update_documents(filter, update, upsert, False)
+
+    def update_many(self, filter, update, upsert=False):
+        return self.update_documents(filter, update, upsert, True)
+
+    def replace_one(self, filter, document, upsert=False):
+        return self.update_documents(filter, document, upsert, False)
+
+    def delete_documents(self, filter, many):
+        deleted = 0
+        with self.database.transaction():
+            for document in self.rows(filter):
+                key = encode(document["_id"])
+                self.database.execute(
+                    "DELETE FROM %s WHERE _id = ?" % self.table, (key,)
+                )
+                for table in self.indexes.values():
+                    self.database.execute(
+                        "DELETE FROM %s WHERE _id = ?" % table, (key,)
+                    )
+                deleted += 1
+                if not many:
+                    break
+        return DeleteResult(deleted)
+
+    def delete_one(self, filter):
+        return self.delete_documents(filter, False)
+
+    def delete_many(self, filter):
+        return self.delete_documents(filter, True)
+
+    def bulk_write(self, operations, ordered=True):
+        inserted = matched = modified = deleted = 0
+        # one sqlite transaction for the whole batch
+        with self.database.transaction():
+            for op in operations:
+                if isinstance(op, InsertOne):
+                    self.insert_one(op.document)
+                    inserted += 1
+                elif isinstance(op, (UpdateOne, UpdateMany)):
+                    r = self.update_documents(
+                        op.filter, op.update, op.upsert, isinstance(op, UpdateMany)
+                    )
+                    matched += r.matched_count
+                    modified += r.modified_count
+                elif isinstance(op, (DeleteOne, DeleteMany)):
+                    r = self.delete_documents(op.filter, isinstance(op, DeleteMany))
+                    deleted += r.deleted_count
+                else:
+                    raise Error("Unsupported bulk operation: %s" % type(op).__name__)
+        return BulkWriteResult(inserted, matched, modified, deleted)
+
+    def create_index(self, keys, **kwargs):
+        # compound indexes become one index table per field. The query planner
+        # only ever uses one of them, so that's as good as it gets here
+        if isinstance(keys, str):
+            keys = [(keys, ASCENDING)]
+        with self.database.transaction():
+            for field, direction in keys:
+                if field in self.indexes:
+                    continue
+                table = self.name + "$" + field
+                self.database.execute(
+                    "CREATE TABLE %s (value, _id TEXT NOT NULL)" % quote(table)
+                )
+                self.database.execute(
+                    "CREATE INDEX %s ON %s (value)"
+                    % (quote(table + "$value"), quote(table))
+                )
+                self.database.execute(
+                    "CREATE INDEX %s ON %s (_id)" % (quote(table + "$_id"), quote(table))
+                )
+                self.indexes[field] = quote(table)
+                # index the documents we already have
+                for key, doc in self.database.execute(
+                    "SELECT _id, doc FROM %s" % self.table
+                ):
+                    self.write_index(field, decode(doc), key)
+        return "_".join("%s_%s" % (field, direction) for field, direction in keys)
+
+
+class Cursor:
+    """A lazily evaluated query over a SQLiteRepository"""
+
+    def __init__(self, repository, filter, projection):
+        self.repository = repository
+        self.filter = filter
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self.documents = None
+
+    def sort(self, key, direction=ASCENDING):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, skip):
+        self._skip = skip or 0
+        return self
+
+    def limit(self, limit):
+        self._limit = limit or 0
+        return self
+
+    def rewind(self):
+        self.documents = None
+        return self
+
+    def evaluate(self):
+        documents = list(self.repository.rows(self.filter))
+        if self._sort:
+            sort_documents(documents, self._sort)
+        documents = documents[self._skip :]
+        if self._limit:
+            documents = documents[: self._limit]
+        return [project(d, self.projection) for d in documents]
+
+    def __iter__(self):
+        if self.documents is None:
+            self.documents = self.evaluate()
+        return iter(self.documents)
+
+
+# async access path
+
+
+class QueryStats:
+    """Latency of the queries made against one collection"""
+
+    def __init__(self, samples=1000):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        # the most recent latencies, for percentiles
+        self.samples = deque(maxlen=samples)
+
+    def record(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def report(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class AsyncDatabase:
+    def __init__(self, database, workers=None):
+        self.database = database
+        self.workers = workers or database.settings.get("async_workers", 8)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="storage"
+        )
+        # asyncio primitives belong to the loop that made them, and
+        # run_async starts a new loop per call outside of discord
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.repositories = {}
+
+    def __getitem__(self, name):
+        if name not in self.repositories:
+            self.repositories[name] = AsyncRepository(self, self.database[name])
+            self.stats[name] = QueryStats()
+        return self.repositories[name]
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if loop not in self.semaphores:
+                # a semaphore keeps its loop alive, so drop the finished ones
+                for old in [l for l in self.semaphores if l.is_closed()]:
+                    del self.semaphores[old]
+                self.semaphores[loop] = asyncio.Semaphore(self.workers)
+            return self.semaphores[loop]
+
+    async def run(self, name, function, *args, **kwargs):
+        async with self.semaphore():
+            start = time.perf_counter()
+            error = False
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, lambda: function(*args, **kwargs)
+                )
+            except Exception:
+                error = True
+                raise
+            finally:
+                self.stats[name].record(time.perf_counter() - start, error)
+
+    def report(self):
+        """Returns the latency stats of every collection used so far"""
+        return {name: stats.report() for name, stats in self.stats.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class AsyncRepository:
+    """Awaitable version of a Repository. find() returns a list"""
+
+    def __init__(self, database, repository):
+        self.database = database
+        self.repository = repository
+        self.name = repository.name
+
+    def call(self, method, *args, **kwargs):
+        return self.database.run(
+            self.name, getattr(self.repository, method), *args, **kwargs
+        )
+
+    def find_one(self, *args, **kwargs):
+        return self.call("find_one", *args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return self.database.run(
+            self.name, lambda: list(self.repository.find(*args, **kwargs))
+        )
+
+    def count_documents(self, *args, **kwargs):
+        return self.call("count_documents", *args, **kwargs)
+
+    def insert_one(self, *args, **kwargs):
+        return self.call("insert_one", *args, **kwargs)
+
+    def insert_many(self, *args, **kwargs):
+        return self.call("insert_many", *args, **kwargs)
+
+    def update_one(self, *args, **kwargs):
+        return self.call("update_one", *args, **kwargs)
+
+    def update_many(self, *args, **kwargs):
+        return self.call("update_many", *args, **kwargs)
+
+    def replace_one(self, *args, **kwargs):
+        return self.call("replace_one", *args, **kwargs)
+
+    def delete_one(self, *args, **kwargs):
+        return self.call("delete_one", *args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        return self.call("delete_many", *args, **kwargs)
+
+    def bulk_write(self, *args, **kwargs):
+        return self.call("bulk_write", *args, **kwargs)
+
+
+def storage_test(settings=None):
+    """Runs the same set of checks against whichever engine is configured"""
+    settings = settings or {"engine": "sqlite", "path": ":memory:"}
+    db = connect(settings)
+    col = db["storage_test"]
+    col.delete_many({})
+    tests = []
+
+    db.ensure_indexes({"storage_test": [[("user", ASCENDING)], [("roles.end", 1)]]})
+    tests.append(["indexed", not col.is_collection_scan({"user": 1})])
+    tests.append(["array index", not col.is_collection_scan({"roles.end": {"$lte": 1}})])
+    tests.append(["unindexed", col.is_collection_scan({"cookies": 1})])
+    col.insert_one({"user": 1, "cookies": 5, "items": {"Milk": 2}})
+    col.insert_one({"user": 2, "cookies": 0, "roles": [{"end": 10, "server": 1}]})
+    tests.append(["find_one", col.find_one({"user": 1})["cookies"] == 5])
+    tests.append(["missing", col.find_one({"user": 3}) is None])
+    col.update_one({"user": 1}, {"$inc": {"cookies": 3, "items.Milk": -1}})
+    user = col.find_one({"user": 1}, {"cookies": True, "items": True})
+    tests.append(["$inc", user["cookies"] == 8 and user["items"]["Milk"] == 1])
+    r = col.update_one({"user": 2, "cookies": {"$gte": 1}}, {"$inc": {"cookies": -1}})
+    tests.append(["guarded $inc", r.matched_count == 0])
+    tests.append(["array path", col.count_documents({"roles.end": {"$lte": 10}}) == 1])
+    col.update_one({"user": 2}, {"$pull": {"roles": {"server": 1}}})
+    tests.append(["$pull", col.find_one({"user": 2})["roles"] == []])
+    col.update_one({"user": 4}, {"$set": {"cookies": 1}}, upsert=True)
+    tests.append(["upsert", col.find_one({"user": 4})["cookies"] == 1])
+    col.bulk_write(
+        [
+            UpdateOne({"user": 1}, {"$inc": {"cookies": 1}}),
+            UpdateOne({"user": 5}, {"$inc": {"cookies": 2}}, True),
+            DeleteOne({"user": 4}),
+        ]
+    )
+    tests.append(
+        [
+            "bulk_write",
+            [d["user"] for d in col.find({}, sort=[("cookies", DESCENDING)])]
+            == [1, 5, 2],
+        ]
+    )
+    with col.batch(size=2) as batch:
+        for i in range(3):
+            batch.add(UpdateOne({"user": 2}, {"$inc": {"cookies": 1}}))
+    tests.append(["batch", col.find_one({"user": 2})["cookies"] == 3])
+    col.insert_one({"url": "a", "destinations": [{"target": 1}, {"target": 2}]})
+    col.update_one(
+        {"url": "a", "destinations.target": 2},
+        {"$set": {"destinations.$.keys": "default"}},
+    )
+    tests.append(
+        ["positional", col.find_one({"url": "a"})["destinations"][1]["keys"] == "default"]
+    )
+    col.delete_many({})
+    tests.append(["delete_many", col.count_documents({}) == 0])
+
+    adb = AsyncDatabase(db)
+
+    async def async_test():
+        await adb["storage_test"].insert_one({"user": 6, "cookies": 1})
+        found = await asyncio.gather(
+            *[adb["storage_test"].find_one({"user": 6}) for i in range(20)]
+        )
+        return all(f["cookies"] == 1 for f in found)
+
+    tests.append(["async", asyncio.run(async_test())])
+    tests.append(["async stats", adb.report()["storage_test"]["count"] == 21])
+    adb.close()
+    col.delete_many({})
+
+    for name, passed in tests:
+        print("%s - %s" % (name, passed))
+    db.close()
+    return all(passed for name, passed in tests)
+
+
+if __name__ == "__main__":
+    storage_test()
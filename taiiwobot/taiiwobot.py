@@ -1,7 +1,8 @@
 import os
 import time
 import importlib.machinery
-from . import util, config, plugin
+from . import util, config, plugin, rng
+from .scheduler import Scheduler
 
 
 class TaiiwoBot:
@@ -15,14 +16,41 @@ class TaiiwoBot:
         self.prompt = server.prompt
         self.util = util
         self.plugins = []
+        # pick the storage engine and http pool before any plugin asks for them
+        util.configure_db(config.get("database", {}))
+        util.configure_http(config.get("http", {}))
+        # game randomness, reproducible when "rng_seed" is set
+        rng.configure(config.get("rng_seed"))
+        self.rng = rng
+        # delayed actions, plugins register theirs when they load
+        self.scheduler = Scheduler(server.run_coroutine)
         # load our plugins
         @server.on("ready", "root")
         def server_ready(d):
             if len(self.plugins) == 0:
+                self.scheduler.load()
                 self.plugins = self.load_plugins()
+                self.scheduler.start()
 
         # run the blocking function
-        self.server.start()
+        try:
+            self.server.start()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        # let the plugins save their state, then stop their threads
+        for plugin in self.plugins:
+            plugin.unload()
+        self.scheduler.stop()
+        still_running = util.shutdown()
+        if still_running:
+            print("[W] Threads did not stop in time: %s" % ", ".join(still_running))
+
+    def migrate(self, plugin_class):
+        # make sure the database is ready for the plugin before it starts
+        if plugin_class.indexes:
+            util.get_db().ensure_indexes(plugin_class.indexes)
 
     def load_plugins(self):
         # get all the plugins from the plugin folder
@@ -50,6 +78,7 @@ class TaiiwoBot:
                         if isinstance(getattr(plugin, attr), type):
                             # if the class is based on the plugin class
                             if getattr(plugin, attr).__bases__[0] == plugin.Plugin:
+                                self.migrate(getattr(plugin, attr))
                                 # init the class and add it to the plugin list
                                 plugins.append(getattr(plugin, attr)(self))
                                 break
@@ -86,7 +86,7 @@ class TestServer(Server):
                 # are we waiting for this message?
                 if callback_id == message.target + ":" + message.author_id:
                     # run the message callback
-                    callback[1](message)
+                    util.run_async(callback[1](message))
                     del self.message_callbacks[callback_id]
                     break
                 timeout = callback[2] if len(callback) > 2 else 60.0
@@ -1,15 +1,161 @@
-from concurrent.futures import process
-import pymongo
+from concurrent.futures import process, ThreadPoolExecutor
 import requests
+import builtins
+import inspect
+import asyncio
+import time
 import sys
 import os
-from threading import Thread
+from threading import Thread, Event, Lock, current_thread, active_count, local
 
 
-def thread(func, args=[], kwargs={}):
-    thread = Thread(target=func, args=args, kwargs=kwargs)
-    thread.start()
-    return thread
+# Managed threads
+#
+# Long running loops are started with thread() and get a name and a stop
+# flag. Loops should wait with util.sleep() instead of time.sleep(), which
+# returns True as soon as the loop has been asked to stop. Short jobs go
+# through submit(), which runs them on a bounded pool.
+
+workers = {}
+workers_lock = Lock()
+# the Worker running on the current thread, if any
+worker_local = local()
+max_jobs = 8
+jobs = None
+
+
+class Worker:
+    """A named long running thread that can be asked to stop"""
+
+    def __init__(self, name, func, args, kwargs):
+        self.name = name
+        self.func = func
+        self.stop_event = Event()
+        self.started = time.time()
+        self.thread = Thread(
+            target=self.run, args=args, kwargs=kwargs, name=name, daemon=True
+        )
+
+    def run(self, *args, **kwargs):
+        worker_local.worker = self
+        try:
+            self.func(*args, **kwargs)
+        finally:
+            with workers_lock:
+                if workers.get(self.name) is self:
+                    del workers[self.name]
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopping(self):
+        return self.stop_event.is_set()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def cpu_time(self):
+        # seconds of CPU this thread has used. Not available on every platform
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(self.thread.ident))
+        except (AttributeError, OSError, TypeError):
+            return None
+
+
+def thread(func, args=[], kwargs={}, name=None):
+    """Starts a long running loop in a named, registered thread
+
+    Returns:
+        Worker: The worker. Call .stop() to ask the loop to finish
+    """
+    name = name or getattr(func, "__qualname__", "thread")
+    with workers_lock:
+        # keep names unique, eg. the old loop of a reloaded plugin
+        unique, i = name, 1
+        while unique in workers:
+            i += 1
+            unique = "%s#%s" % (name, i)
+        worker = Worker(unique, func, args, kwargs)
+        workers[unique] = worker
+    worker.thread.start()
+    return worker
+
+
+def current_worker():
+    return getattr(worker_local, "worker", None)
+
+
+def stopping():
+    # True if the calling worker has been asked to stop
+    worker = current_worker()
+    return bool(worker and worker.stopping())
+
+
+def sleep(seconds):
+    """Sleeps, waking early if the calling worker is asked to stop
+
+    Returns:
+        bool: True if the worker should stop
+    """
+    worker = current_worker()
+    if not worker:
+        time.sleep(max(seconds, 0))
+        return False
+    return worker.stop_event.wait(max(seconds, 0))
+
+
+def submit(func, *args, **kwargs):
+    """Runs a short job on the bounded job pool
+
+    Returns:
+        Future: The result of the job
+    """
+    global jobs
+    with workers_lock:
+        if not jobs:
+            jobs = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
+    return jobs.submit(func, *args, **kwargs)
+
+
+def shutdown(timeout=5):
+    """Stops every worker and the job pool, waiting up to timeout seconds"""
+    global jobs
+    with workers_lock:
+        running = list(workers.values())
+    for worker in running:
+        worker.stop()
+    deadline = time.time() + timeout
+    for worker in running:
+        if worker.thread is not current_thread():
+            worker.join(max(deadline - time.time(), 0))
+    if jobs:
+        jobs.shutdown(wait=False)
+        jobs = None
+    close_http()
+    return [w.name for w in running if w.is_alive()]
+
+
+def thread_report():
+    """Returns what every registered thread is and how much CPU it has used"""
+    with workers_lock:
+        running = list(workers.values())
+    return {
+        "threads": active_count(),
+        "queued_jobs": jobs._work_queue.qsize() if jobs else 0,
+        "workers": [
+            {
+                "name": w.name,
+                "alive": w.is_alive(),
+                "stopping": w.stopping(),
+                "uptime": time.time() - w.started,
+                "cpu": w.cpu_time(),
+            }
+            for w in running
+        ],
+    }
 
 
 def maketiny(url):  # make a tinyurl from a string
@@ -23,15 +169,84 @@ def maketiny(url):  # make a tinyurl from a string
 
 
 db = False
+db_settings = {}
+
+
+def configure_db(settings):
+    # sets the "database" config section used by the next get_db() call
+    global db, db_settings
+    if db:
+        db.close()
+    db = False
+    db_settings = settings or {}
 
 
 def get_db():
     global db
     if not db:
-        db = pymongo.MongoClient()["taiiwobot"]
+        from . import storage
+
+        db = storage.connect(db_settings)
     return db
 
 
+http_client = False
+http_settings = {}
+
+
+def configure_http(settings):
+    # sets the "http" config section used by the next get_http() call
+    global http_settings
+    close_http()
+    http_settings = settings or {}
+
+
+def get_http():
+    # the shared, pooled HTTP client. Use it for anything that polls the web
+    global http_client
+    with workers_lock:
+        if not http_client:
+            from . import fetch
+
+            http_client = fetch.Fetcher(**http_settings)
+    return http_client
+
+
+def close_http():
+    global http_client
+    if http_client:
+        http_client.close()
+        http_client = False
+
+
+async_db = False
+
+
+def get_async_db():
+    # the same database as get_db(), but awaitable. Use this from coroutines
+    global async_db
+    if not async_db or async_db.database is not get_db():
+        from . import storage
+
+        async_db = storage.AsyncDatabase(get_db())
+    return async_db
+
+
+def run_async(result):
+    """Schedules the result of a callback if it's a coroutine
+
+    Lets plugins use `async def` for commands and callbacks. Inside the event
+    loop the coroutine becomes a task, anywhere else it's run to completion.
+    """
+    if not inspect.iscoroutine(result):
+        return result
+    try:
+        loop = asyncio.get_running_loop()
+    except builtins.RuntimeError:
+        return asyncio.run(result)
+    return loop.create_task(result)
+
+
 def debug(msg):
     print(msg)
 
@@ -46,7 +261,7 @@ def missing_keys(keys, dict):
 
 def callback(callbacks, data):
     for callback in callbacks:
-        callback(data)
+        run_async(callback(data))
 
 
 # universal message object
@@ -275,7 +490,8 @@ class Interface:
                 o_message.target,
                 self.func.__self__,
             ) from e
-        return resp
+        # async commands are scheduled rather than run inline
+        return run_async(resp)
 
 
 def interface_test():